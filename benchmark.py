@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from utils import start_logger
+from src.config import Config
+from src.recording import Recording
+from src.synthetic import generate_recording
+from src.utils import match_peaks, apply_shannon_entropy
+
+stages = ['process_ecg', 'process_imu', 'process_bcg', 'process_imu_bcg', 'process_bp', 'process_ppg', 'process_head_ppg']
+
+def outlier_free_index(raw: pd.Series, indices: np.ndarray) -> np.ndarray:
+    # Only Config.outlier_handling = 'drop' removes samples, the ground truth is then moved to the index it gets in each channel
+    if Config.outlier_handling != 'drop':
+        return np.asarray(indices)
+    kept = np.flatnonzero(raw.between(raw.quantile(0.01), raw.quantile(0.98)))
+    return np.searchsorted(kept, indices)
+
+def run_stages(recording: Recording, memory: bool = False) -> dict:
+    results = {}
+    for stage in stages:
+        if memory:
+            tracemalloc.start()
+            getattr(recording, stage)()
+            results[stage] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        else:
+            start, cpu = time.perf_counter(), time.process_time()
+            getattr(recording, stage)()
+            results[stage] = {'wall_s': time.perf_counter() - start, 'cpu_s': time.process_time() - cpu}
+    return results
+
+def accuracy(recording: Recording, df: pd.DataFrame, truth: dict, fs: int) -> dict:
+    tolerance = int(0.05 * fs)
+    head_entropy = apply_shannon_entropy(df.filter(regex='head forehead PPG'), Config.entropy_reduction)
+    fiducials = {
+        'R': (df['chest sternum ECG'], truth['R'], recording.ecg.peak_indices_corrected),
+        'I': (df['force plate BCG'], truth['I'], recording.IJK[0]),
+        'J': (df['force plate BCG'], truth['J'], recording.IJK[1]),
+        'K': (df['force plate BCG'], truth['K'], recording.IJK[2]),
+        'imu_J': (np.sqrt((df.filter(regex='IMU') ** 2).sum(axis=1)), truth['J'], recording.imu_IJK[1]),
+        'trough': (df['finger PPG'], truth['trough'], recording.ppg.troughs),
+        'head_trough': (head_entropy, truth['head_trough'], recording.processed_head_ppg.troughs)
+    }
+    results = {}
+    for name, (raw, reference, detected) in fiducials.items():
+        matched = match_peaks(outlier_free_index(raw, reference), detected, tolerance)
+        results[name] = {
+            'sensitivity': matched['sensitivity'],
+            'ppv': matched['ppv'],
+            'mean_offset_ms': matched['mean_offset'] * 1000 / fs,
+            'max_offset_ms': matched['max_offset'] * 1000 / fs
+        }
+    results['ptt_error_ms'] = float(np.mean(recording.ppg.ptts) - np.mean(truth['ptt']))
+    results['head_ptt_error_ms'] = float(np.mean(recording.processed_head_ppg.ptts) - np.mean(truth['head_ptt']))
+    results['heart_rate_error_bpm'] = float(recording.heart_rate - 60 / (np.diff(truth['R']).mean() / fs))
+    return results
+
+def fiducials(recording: Recording) -> dict:
+    return {
+        'R': recording.ecg.peak_indices_corrected,
+        'I': recording.IJK[0],
+        'J': recording.IJK[1],
+        'K': recording.IJK[2],
+        'imu_J': recording.imu_IJK[1],
+        'trough': recording.ppg.troughs,
+        'head_trough': recording.processed_head_ppg.troughs
+    }
+
+def variant(recording: Recording, df: pd.DataFrame, truth: dict, fs: int, logger, **overrides) -> dict:
+    # Same recording with some Config attributes overridden, compared with the default fiducials and with the ground truth
+    previous = {name: getattr(Config, name) for name in overrides}
+    for name, value in overrides.items():
+        setattr(Config, name, value)
+    try:
+        other = Recording(df, logger, 10, fs=fs)
+        timings = run_stages(other)
+        memory = run_stages(Recording(df, logger, 10, fs=fs), memory=True)
+    finally:
+        for name, value in previous.items():
+            setattr(Config, name, value)
+    agreement = {}
+    for name, indices in fiducials(other).items():
+        reference = fiducials(recording)[name]
+        matched = match_peaks(reference, indices, int(0.01 * fs))
+        agreement[name] = {
+            'identical': match_peaks(reference, indices, 0)['sensitivity'],
+            'sensitivity': matched['sensitivity'],
+            'mean_offset_ms': matched['mean_offset'] * 1000 / fs,
+            'max_offset_ms': matched['max_offset'] * 1000 / fs
+        }
+    return {
+        **overrides,
+        'total_wall_s': sum(timing['wall_s'] for timing in timings.values()),
+        'peak_memory_mb': max(memory.values()),
+        'vs_default': agreement,
+        'accuracy': accuracy(other, df, truth, fs)
+    }
+
+def concurrent(recording: Recording, df: pd.DataFrame, fs: int, logger, backend: str) -> dict:
+    # Same recording with the independent stages run at the same time (Recording.run), its fiducials must be the serial ones
+    other = Recording(df, logger, 10, fs=fs)
+    start = time.perf_counter()
+    other.run(stages, backend=backend)
+    wall = time.perf_counter() - start
+    identical = {name: bool(np.array_equal(indices, fiducials(other)[name])) for name, indices in fiducials(recording).items()}
+    return {'backend': backend, 'total_wall_s': wall, 'identical': identical}
+
+def benchmark(duration: float, fs: int, logger, seed: int = 0, variants: dict = None, backend: str = None) -> dict:
+    df, truth = generate_recording(duration, fs=fs, seed=seed)
+    recording = Recording(df, logger, 10, fs=fs)
+    timings = run_stages(recording)
+    memory = run_stages(Recording(df, logger, 10, fs=fs), memory=True)
+    result = {
+        'duration_s': duration,
+        'samples': len(df),
+        'stages': {stage: {**timings[stage], 'samples_per_s': len(df) / timings[stage]['wall_s'], 'peak_memory_mb': memory[stage]} for stage in stages},
+        'total_wall_s': sum(timing['wall_s'] for timing in timings.values()),
+        'accuracy': accuracy(recording, df, truth, fs)
+    }
+    result['peak_memory_mb'] = max(memory.values())
+    result['variants'] = {name: variant(recording, df, truth, fs, logger, **overrides) for name, overrides in (variants or {}).items()}
+    if backend:
+        result['concurrent'] = concurrent(recording, df, fs, logger, backend)
+    return result
+
+def compare(results: list, baseline: list, logger) -> None:
+    previous = {result['duration_s']: result for result in baseline}
+    for result in results:
+        old = previous.get(result['duration_s'])
+        if old is None:
+            continue
+        for stage in [stage for stage in stages if stage in old['stages']]:
+            ratio = result['stages'][stage]['wall_s'] / old['stages'][stage]['wall_s']
+            logger.info(f'{result["duration_s"]:>6.0f} s  {stage:<17} {ratio:5.2f}x baseline wall time')
+        for name, metrics in result['accuracy'].items():
+            if isinstance(metrics, dict) and name in old['accuracy'] and metrics['sensitivity'] < old['accuracy'][name]['sensitivity']:
+                logger.warning(f'{result["duration_s"]:>6.0f} s  {name} sensitivity dropped from {old["accuracy"][name]["sensitivity"]:.3f} to {metrics["sensitivity"]:.3f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Recording stages on synthetic signals with known fiducial points')
+    parser.add_argument('--durations', type=float, nargs='+', default=[60, 600, 3600], help='Recording lengths in seconds')
+    parser.add_argument('--fs', type=int, default=2000)
+    parser.add_argument('--output', default='benchmarks/results.json', help='Where to write the results')
+    parser.add_argument('--compare', default=None, help='Baseline results to compare against')
+    parser.add_argument('--working-fs', type=int, default=None, help='Also run at this working rate (Config.working_fs) and report its agreement with the full-rate path')
+    parser.add_argument('--dtype', default=None, help='Also run with this dtype (Config.dtype, e.g. float32) and report its agreement with the float64 path')
+    parser.add_argument('--outlier-modes', nargs='+', default=[], choices=['none', 'clip', 'interpolate', 'drop'], help='Also run with these Config.outlier_handling modes and report their BCG / PPG accuracy')
+    parser.add_argument('--concurrent', default=None, choices=['thread', 'process'], help='Also run the independent stages at the same time (Recording.run) with this backend and check that the fiducials are identical')
+    args = parser.parse_args()
+
+    logger = start_logger('benchmark')
+    logger.setLevel('WARNING')
+    variants = {}
+    if args.working_fs:
+        variants[f'working_fs={args.working_fs}'] = {'working_fs': args.working_fs}
+    if args.dtype:
+        variants[f'dtype={args.dtype}'] = {'dtype': args.dtype}
+    for mode in args.outlier_modes:
+        variants[f'outlier_handling={mode}'] = {'outlier_handling': None if mode == 'none' else mode}
+    results = [benchmark(duration, args.fs, logger, variants=variants, backend=args.concurrent) for duration in args.durations]
+    logger.setLevel('INFO')
+    for result in results:
+        accuracy_summary = ', '.join(f'{name} {metrics["sensitivity"]:.2f}/{metrics["mean_offset_ms"]:.1f} ms' for name, metrics in result['accuracy'].items() if isinstance(metrics, dict))
+        logger.info(f'{result["duration_s"]:>6.0f} s  total {result["total_wall_s"]:.2f} s  ' + ', '.join(f'{stage} {timing["wall_s"]:.2f} s / {timing["peak_memory_mb"]:.0f} MB' for stage, timing in result['stages'].items()))
+        logger.info(f'{result["duration_s"]:>6.0f} s  sensitivity / offset: {accuracy_summary}, PTT error {result["accuracy"]["ptt_error_ms"]:.1f} ms')
+        for name, other in result['variants'].items():
+            agreement = ', '.join(f'{fiducial} {metrics["identical"]:.2f}/{metrics["sensitivity"]:.2f}/{metrics["mean_offset_ms"]:.2f} ms' for fiducial, metrics in other['vs_default'].items())
+            logger.info(f'{result["duration_s"]:>6.0f} s  {name}: total {other["total_wall_s"]:.2f} s ({result["total_wall_s"] / other["total_wall_s"]:.1f}x), peak {other["peak_memory_mb"]:.0f} MB ({result["peak_memory_mb"]:.0f} MB), identical / within 10 ms / offset vs default: {agreement}')
+            accuracy_summary = ', '.join(f'{fiducial} {metrics["sensitivity"]:.2f}/{metrics["mean_offset_ms"]:.1f} ms' for fiducial, metrics in other['accuracy'].items() if isinstance(metrics, dict))
+            logger.info(f'{result["duration_s"]:>6.0f} s  {name}: sensitivity / offset: {accuracy_summary}, PTT error {other["accuracy"]["ptt_error_ms"]:.1f} ms')
+        if 'concurrent' in result:
+            other = result['concurrent']
+            logger.info(f'{result["duration_s"]:>6.0f} s  concurrent ({other["backend"]}): total {other["total_wall_s"]:.2f} s ({result["total_wall_s"] / other["total_wall_s"]:.1f}x), identical fiducials: {all(other["identical"].values())}')
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__, 'results': results}, f, indent=2)
+    logger.info(f'Results written to {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'], logger)
@@ -4,7 +4,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from utils import *
+from src.config import Config
 from src.recording import Recording
+from src.result_cache import Result_Cache
 
 cwd = os.getcwd()
 tar_path = f'{cwd}/data/ptt_dataset.tar'
@@ -13,32 +15,46 @@ file_path = f'{extraction_path}/gt03.csv'
 
 # Start logging
 logger = start_logger()
+# Uncomment to record time and memory of every processing stage (profiler.report() returns them as a DataFrame)
+#from src.profiler import profiler
+#profiler.enable()
 
 # Extract the tar file
 #read_from_tar(tar_path, logger, extraction_path)
-
-df = load_df_from_csv(file_path)
-recording = Recording(df, logger, 10)
+# or read a subject straight from it
+#df = load_df_from_tar(tar_path, 'gt03')
+
+session = 10
+df = load_session(file_path, session, columns=Recording.columns, logger=logger, dtype=Config.dtype)
+# Stage outputs are stored on disk and reused while the data and the parameters of the stage are unchanged
+cache = Result_Cache(f'{extraction_path}/.cache/results')
+recording = Recording(df, logger, session, cache=cache)
+# For files larger than memory, stream one session at a time instead:
+#for session, df in iter_sessions(file_path, columns=Recording.columns, dtype=Config.dtype): recording = Recording(df, logger, session)
 idx = slice(2000,7000)
-recording.process_ecg()
-recording.process_imu()
-recording.process_bcg()
-recording.process_bp()
-recording.process_ppg()
-recording.process_systolic_p()
-recording.process_diastolic_p()
-recording.process_head_ppg()
-title  = f'{recording.state}  -- {recording.head_avg_ptt} ms -- {recording.ecg.heart_rate} bpm'
+# The process_* stages run on first access of their outputs (see Recording.outputs)
+# or all at once, the independent ones at the same time:
+#recording.run(backend='thread')
+title  = f'{recording.state}  -- {recording.head_avg_ptt} ms -- {recording.heart_rate} bpm'
 #plot_signals_with_marker(recording.ecg.raw_ecg[idx], recording.processed_head_ppg.filtered_ppg[idx],marker = recording.r_peaks_corrected[idx], title = title)
 
-plt.scatter(recording.bp[recording.ppg.troughs], np.array(recording.ppg.ptts) * 1000 / recording.fs, color='red')
+# One row per beat, PTT variants are columns of the beat table (see src/beat_table.py)
+beats = recording.beats
+plt.scatter(beats['bp'], beats['ptt_r_head_trough'], color='red')
 
-plt.title(f'PTT vs Blood Pressure (ECG R-Peaks and Head PPG) (Corr. {np.corrcoef(recording.bp[recording.IJK[0][:-1]], np.array(recording.processed_head_ppg.ptts) * 1000 / recording.fs)[0,1]:.2f})')
+plt.title(f'PTT vs Blood Pressure (ECG R-Peaks and Head PPG) (Corr. {beats["bp"].corr(beats["ptt_r_head_trough"]):.2f})')
 plt.xlabel('Blood Pressure (mmHg)')
 plt.ylabel('PTT (ms)')
 plt.show()
 
+# Correlation over the last 60 beats and the PTT -> systolic pressure calibration, updated beat by beat (see src/calibration.py)
+#from src.calibration import track_ptt_bp
+#tracking = track_ptt_bp(beats, 'ptt_r_head_trough', 'systolic', window=60)
+#plot_signal(tracking['corr'], by_time=False)
+
 # Plot the data
 #plot_signal_with_markers(recording.bcg.filtered_bcg[idx],recording.I_valleys[idx],recording.J_peaks[idx], recording.K_valleys[idx],title = title)
 #plot_signal_with_markers(recording.ecg.raw_ecg[idx], recording.r_peaks_corrected[idx],title = title)
+# Whole session, written to a file instead of shown
+#plot_signal_with_markers(recording.ecg.raw_ecg, recording.r_peaks_corrected, title = title, save_path = 'r_peaks.png')
 #plot_signals_with_marker(recording.systolic_p[idx],recording.diastolic_p[idx], marker = recording.r_peaks_corrected[idx],title = title)
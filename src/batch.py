@@ -0,0 +1,98 @@
+import os
+import logging
+import pandas as pd
+from typing import List
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.config import Config, config_snapshot, apply_config
+from src.recording import Recording
+from src.profiler import profiler
+from src.result_cache import Result_Cache
+from utils import load_session, is_cache_valid, build_session_cache
+
+def summarize(recording: Recording) -> dict:
+    '''
+    Heart rate, average PTTs and PTT - BP correlations of a processed (or lazily processed) recording
+    '''
+    return {
+        'beats': len(recording.ecg.peak_indices_corrected),
+        'heart_rate': recording.ecg.heart_rate,
+        'finger_avg_ptt': recording.finger_avg_ptt,
+        'head_avg_ptt': recording.head_avg_ptt,
+        'finger_bp_corr': recording.beats['bp'].corr(recording.beats['ptt_r_trough']),
+        'head_bp_corr': recording.beats['bp'].corr(recording.beats['ptt_r_head_trough']),
+        'imu_bp_corr': recording.beats['bp'].corr(recording.beats['ptt_r_imu_j']),
+        'error': None
+    }
+
+def session_row(file_path: str, session: int) -> dict:
+    subject = os.path.splitext(os.path.basename(file_path))[0]
+    return {'subject': subject, 'session': session, 'state': Config.activities[session]}
+
+def process_session(file_path: str, session: int, profile: bool = False, cache_dir: str = None) -> dict:
+    '''
+    Run ECG -> BCG -> PPG -> Head PPG processing for one session of one subject
+    Input:
+        file_path: str: The csv file of the subject
+        session: int: The session
+        profile: bool: Attach the per-stage profiler records of the session (see src.profiler)
+        cache_dir: str: Directory of a Result_Cache to reuse stage outputs from (no caching by default)
+    Output:
+        dict: PTT, heart rate and BP correlation of the session (error is set instead if processing failed)
+    '''
+    logger = logging.getLogger('batch')
+    result = session_row(file_path, session)
+    if profile:
+        profiler.clear()
+        profiler.enable()
+    try:
+        df = load_session(file_path, session, columns=Recording.columns, logger=logger, dtype=Config.dtype)
+        recording = Recording(df, logger, session, cache=Result_Cache(cache_dir) if cache_dir else None)
+        result.update(summarize(recording))
+    except Exception as e:
+        logger.exception(f'Processing failed for {result["subject"]} session {session}')
+        result['error'] = repr(e)
+    if profile:
+        profiler.disable()
+        result['profile'] = profiler.records
+    return result
+
+def run_batch(file_paths: List[str], sessions: List[int] = None, logger: logging.Logger = None, max_workers: int = None, profile: bool = False, cache_dir: str = None) -> pd.DataFrame:
+    '''
+    Process every session of every subject in a process pool
+    Every worker loads only its own session from the column cache (see utils.load_session).
+    A failing session, an unreadable file (all its sessions) or a worker that died is reported in the error column and does not stop the others.
+    Input:
+        file_paths: List[str]: The csv files of the subjects
+        sessions: List[int]: The sessions to process (all activities by default)
+        max_workers: int: The number of processes (all cores by default)
+        profile: bool: Add a profile column with the per-stage records of every session
+        cache_dir: str: Result_Cache directory shared by the workers (see src.result_cache)
+    Output:
+        pd.DataFrame: One row per subject and session
+    '''
+    sessions = list(Config.activities.keys()) if sessions is None else sessions
+    # Build the caches up front so that the workers do not race to write them
+    failed = {}
+    for file_path in file_paths:
+        try:
+            if not is_cache_valid(file_path):
+                build_session_cache(file_path, logger)
+        except Exception as e:
+            if logger:
+                logger.exception(f'Reading {file_path} failed')
+            failed[file_path] = repr(e)
+    results = [{**session_row(file_path, session), 'error': error} for file_path, error in failed.items() for session in sessions]
+    # The workers process with the Config of the caller, also under the spawn start method (see config_snapshot)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=apply_config, initargs=(config_snapshot(),)) as executor:
+        futures = {executor.submit(process_session, file_path, session, profile, cache_dir): (file_path, session) for file_path in file_paths if file_path not in failed for session in sessions}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker died (e.g. killed when out of memory), the pool then fails its remaining tasks as well
+                result = {**session_row(*futures[future]), 'error': repr(e)}
+            if logger:
+                logger.info(f'{result["subject"]} session {result["session"]} ({result["state"]}) ' + (f'failed: {result["error"]}' if result['error'] else 'done'))
+            results.append(result)
+    return pd.DataFrame(results).sort_values(['subject', 'session']).reset_index(drop=True)
@@ -1,20 +1,38 @@
 import pandas as pd
+import numpy as np
 from logging import Logger
 from typing import Any, List
 
 from src.utils import *
+from src.filter_bank import Filter_Bank
+from src.profiler import profiler
+from src.beat_quality import j_peak_quality
 
 class BCG_Signal:
-    def __init__(self, raw_signal: pd.Series, fs: int, logger: Logger, cfg: Any) -> None:
-        self.raw_bcg = remove_outliers(raw_signal)
+    def __init__(self, raw_signal: pd.Series, fs: int, logger: Logger, cfg: Any, working_fs: int = None, outliers: str = 'clip', outlier_z: float = 5) -> None:
+        # Robust bounds (outlier_z scaled MADs) instead of the quantiles, which would flatten the J apexes
+        self.raw_bcg = clip_outliers(raw_signal, outliers, max_z=outlier_z)
         self.logger = logger
         self.fs = fs
         self.cfg = cfg
+        self.decimation = decimation_factor(fs, working_fs)
     
-    def process(self, r_peaks: List[int]) -> pd.Series:
-        self.filtered_bcg = apply_bp_filter(signal=self.raw_bcg, fs = self.fs, **self.cfg.BPF_Param).rename(f'{self.raw_bcg.name} (Filtered)')
-        self.filtered_bcg = apply_rolling_ema(self.filtered_bcg, **self.cfg.EMA_Param).rename(f'{self.filtered_bcg.name} (Smoothed)')
-        self.J_peaks = calculate_peak_indices_conditioned(self.filtered_bcg, fs=self.fs, r_peaks=r_peaks)
-        self.I_valleys, self.K_valleys = calculate_valleys(self.filtered_bcg, self.J_peaks, self.fs)
+    def process(self, r_peaks: List[int], max_z: float = None) -> pd.Series:
+        # With a working rate, filtered_bcg is at fs / decimation and the fiducials are refined back to full-rate indices
+        # With max_z, beats whose J amplitude or R - J latency is an outlier are dropped before the valley search (self.r_peaks keeps the R-peaks of the remaining beats)
+        n, q = len(self.raw_bcg), self.decimation
+        self.r_peaks = np.asarray(r_peaks, dtype=np.int64)
+        with profiler.measure(f'{type(self).__name__}.filter', n):
+            filtered = Filter_Bank(self.fs // q, self.cfg, q).apply(decimate_signal(self.raw_bcg, q), stages=['bandpass', 'ema'])
+            self.filtered_bcg = pd.Series(filtered, name=f'{self.raw_bcg.name} (Filtered) (Smoothed)')
+        with profiler.measure(f'{type(self).__name__}.J_peaks', n):
+            J_peaks = calculate_peak_indices_conditioned(self.filtered_bcg, fs=self.fs // q, r_peaks=self.r_peaks // q)
+        if max_z is not None:
+            with profiler.measure(f'{type(self).__name__}.J_quality', n):
+                keep = j_peak_quality(self.filtered_bcg, self.r_peaks // q, J_peaks, self.fs // q, max_z)
+                J_peaks, self.r_peaks = np.asarray(J_peaks)[keep].tolist(), self.r_peaks[keep]
+        with profiler.measure(f'{type(self).__name__}.IK_valleys', n):
+            I_valleys, K_valleys = calculate_valleys(self.filtered_bcg, J_peaks, self.fs // q)
+        self.I_valleys, self.J_peaks, self.K_valleys = [np.minimum(refine_indices(self.filtered_bcg, indices, q), n - 1).tolist() for indices in [I_valleys, J_peaks, K_valleys]]
         
         return self.I_valleys, self.J_peaks, self.K_valleys
\ No newline at end of file
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+from typing import List, Union
+from scipy.cluster.vq import kmeans2
+
+from src.utils import as_float_array
+
+def robust_z(values: np.ndarray) -> np.ndarray:
+    '''
+    Distance to the median in units of the scaled median absolute deviation (NaN stays NaN)
+    '''
+    values = np.asarray(values, dtype=float)
+    median = np.nanmedian(values)
+    mad = 1.4826 * np.nanmedian(np.abs(values - median))
+    return (values - median) / mad if mad > 0 else np.zeros_like(values)
+
+def rr_plausibility(r_peaks: np.ndarray, fs: int, min_s: float, max_s: float, deviation: float, beats: int) -> pd.DataFrame:
+    '''
+    RR interval (to the previous beat) of every beat and whether it is physiological and close to the median RR of the surrounding beats
+    The first beat takes the RR interval of the second one.
+    '''
+    rr = np.diff(np.asarray(r_peaks, dtype=np.int64), prepend=np.nan) / fs
+    if len(rr) > 1:
+        rr[0] = rr[1]
+    local = pd.Series(rr).rolling(beats, center=True, min_periods=1).median().to_numpy()
+    ok = (rr >= min_s) & (rr <= max_s) & (np.abs(rr - local) <= deviation * local)
+    return pd.DataFrame({'rr': rr, 'rr_ok': ok})
+
+def template_correlation(signal: Union[pd.Series, np.ndarray], r_peaks: np.ndarray, fs: int, lbound: float, ubound: float) -> np.ndarray:
+    '''
+    Pearson correlation of every beat (the signal from lbound to ubound around R) with the median beat
+    '''
+    x = as_float_array(signal)
+    offsets = np.arange(int(lbound * fs), int(ubound * fs))
+    if len(r_peaks) == 0:
+        return np.empty(0)
+    segments = x[np.clip(np.asarray(r_peaks, dtype=np.int64)[:, None] + offsets[None, :], 0, len(x) - 1)]
+    segments = segments - segments.mean(axis=1, keepdims=True)
+    template = np.median(segments, axis=0)
+    norms = np.linalg.norm(segments, axis=1) * np.linalg.norm(template)
+    return np.divide(segments @ template, norms, out=np.zeros(len(segments)), where=norms > 0)
+
+def ecg_beat_quality(signal: Union[pd.Series, np.ndarray], r_peaks: List[int], fs: int, cfg) -> pd.DataFrame:
+    '''
+    Score every R-peak from the ECG alone (RR plausibility and correlation with the median beat)
+    Input:
+        signal: Union[pd.Series, np.ndarray]: The ECG the R-peaks were corrected on
+        r_peaks: List[int]: The R-peaks
+        fs: int: The sampling frequency
+        cfg: Config.Beat_Param
+    Output:
+        pd.DataFrame: One row per R-peak with R, rr, rr_ok, template_corr and ok (the beat is kept)
+    '''
+    r_peaks = np.asarray(r_peaks, dtype=np.int64)
+    quality = rr_plausibility(r_peaks, fs, **cfg.RR_Param)
+    quality.insert(0, 'R', r_peaks)
+    quality['template_corr'] = template_correlation(signal, r_peaks, fs, cfg.Template_Param['lbound'], cfg.Template_Param['ubound'])
+    quality['ok'] = quality['rr_ok'] & (quality['template_corr'] >= cfg.Template_Param['min_corr'])
+    return quality
+
+def j_peak_quality(signal: Union[pd.Series, np.ndarray], r_peaks: List[int], J_peaks: List[int], fs: int, max_z: float) -> np.ndarray:
+    '''
+    Whether the J amplitude and the R - J latency of every beat are within max_z robust standard deviations of the session
+    Input:
+        signal: Union[pd.Series, np.ndarray]: The filtered BCG the J-peaks were found on
+        r_peaks, J_peaks: List[int]: The R-peaks and the J-peak found for each of them
+    Output:
+        np.ndarray: One boolean per beat
+    '''
+    J_peaks = np.asarray(J_peaks, dtype=np.int64)
+    amplitude = as_float_array(signal)[J_peaks]
+    latency = (J_peaks - np.asarray(r_peaks, dtype=np.int64)) / fs
+    return (np.abs(robust_z(amplitude)) <= max_z) & (np.abs(robust_z(latency)) <= max_z)
+
+def cluster_ptts(ptts: Union[pd.Series, np.ndarray], method: str = 'kmeans', n_clusters: int = 2, max_z: float = 3, max_share: float = 0.25, seed: int = 0) -> np.ndarray:
+    '''
+    Inliers of a PTT distribution (NaN PTTs are never inliers)
+    kmeans: n_clusters 1-D K-means clusters; a cluster is rejected only if it holds at most max_share of the beats and its
+    centroid is more than max_z robust standard deviations (of all PTTs) away from the most populated one, so a unimodal
+    distribution keeps all its beats
+    mad: the beats within max_z robust standard deviations of the median
+    '''
+    assert method in ['kmeans', 'mad'], 'Method must be either "kmeans" or "mad"'
+    values = np.asarray(ptts, dtype=float)
+    present = ~np.isnan(values)
+    inliers = np.zeros(len(values), dtype=bool)
+    if method == 'mad':
+        inliers[present] = np.abs(robust_z(values[present])) <= max_z
+    elif present.sum() > n_clusters:
+        centroids, labels = kmeans2(values[present, None], n_clusters, minit='++', seed=seed)
+        counts = np.bincount(labels, minlength=n_clusters)
+        main = counts.argmax()
+        spread = 1.4826 * np.median(np.abs(values[present] - np.median(values[present])))
+        rejected = (counts <= max_share * present.sum()) & (np.abs(centroids[:, 0] - centroids[main, 0]) > max_z * spread)
+        inliers[present] = ~rejected[labels]
+    else:
+        inliers[present] = True
+    return inliers
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+
+from src.utils import match_events
+
+# Search windows (in seconds) of each fiducial point, relative to the point it is matched to
+windows = {
+    'J': ('R', 0.1, 0.3), # calculate_peak_indices_conditioned defaults
+    'I': ('J', -0.05, 0), # calculate_valleys
+    'K': ('J', 0, 0.05),
+    'trough': ('J', 0.01, 0.2), # PPG_Signal.process
+    'head_trough': ('J', 0.01, 0.2),
+    'imu_J': ('R', 0.1, 0.3), # accelerometer BCG, src/imu_signal.py
+    'imu_I': ('imu_J', -0.05, 0)
+}
+
+# PTT variants as (start, end) fiducial points
+ptts = {
+    'ptt_r_trough': ('R', 'trough'),
+    'ptt_i_trough': ('I', 'trough'),
+    'ptt_r_j': ('R', 'J'),
+    'ptt_r_head_trough': ('R', 'head_trough'),
+    'ptt_i_head_trough': ('I', 'head_trough'),
+    'ptt_r_imu_j': ('R', 'imu_J'),
+    'ptt_imu_i_trough': ('imu_I', 'trough'),
+    'ptt_imu_i_head_trough': ('imu_I', 'head_trough')
+}
+
+def build_beat_table(r_peaks: List[int], I_valleys: List[int], J_peaks: List[int], K_valleys: List[int], troughs: List[int], head_troughs: List[int], bp: pd.Series, fs: int, imu_I_valleys: List[int] = (), imu_J_peaks: List[int] = (), pressures: Dict[str, pd.Series] = None) -> pd.DataFrame:
+    '''
+    Build one row per cardiac cycle (one per R-peak) with the matched fiducial points, the blood pressure at R and the PTTs
+    Every fiducial point is matched to its reference point with a binary search in the same window it was detected in,
+    so beats without a match get <NA> instead of shifting the following rows.
+    Input:
+        r_peaks, I_valleys, J_peaks, K_valleys, troughs, head_troughs: List[int]: The fiducial indices
+        bp: pd.Series: The blood pressure
+        fs: int: The sampling frequency
+        imu_I_valleys, imu_J_peaks: List[int]: The I / J points of the accelerometer BCG (columns stay <NA> without them)
+        pressures: Dict[str, pd.Series]: More pressure signals to sample at R (e.g. systolic / diastolic), one column each
+    Output:
+        pd.DataFrame: The beat table (fiducial indices as Int64, PTTs in ms)
+    '''
+    events = {'I': I_valleys, 'J': J_peaks, 'K': K_valleys, 'trough': troughs, 'head_trough': head_troughs, 'imu_I': imu_I_valleys, 'imu_J': imu_J_peaks}
+    columns = {'R': np.asarray(r_peaks, dtype=np.int64)}
+    for name, (reference, lbound, ubound) in windows.items():
+        columns[name] = match_events(columns[reference], events[name], fs, lbound, ubound)
+    table = pd.DataFrame({name: pd.array(np.where(columns[name] >= 0, columns[name], None), dtype='Int64') for name in ['R', 'I', 'J', 'K', 'trough', 'head_trough', 'imu_I', 'imu_J']})
+    for name, pressure in {'bp': bp, **(pressures or {})}.items():
+        pressure = np.asarray(pressure, dtype=float)
+        valid = (columns['R'] >= 0) & (columns['R'] < len(pressure))
+        table[name] = np.where(valid, pressure[np.clip(columns['R'], 0, len(pressure) - 1)], np.nan)
+    for name, (start, end) in ptts.items():
+        table[name] = ((table[end] - table[start]) * 1000 / fs).astype(float)
+    return table
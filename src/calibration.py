@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+from collections import deque
+
+class Running_Regression:
+    '''
+    Running mean, variance and covariance of (PTT, BP) pairs, updated in O(1) per beat (Welford / West)
+    window: keep only the last window beats (the oldest pair is removed as a new one comes in)
+    halflife: weight past beats by 0.5 ** (age / halflife) instead
+    Without either, all beats since the start are weighted equally.
+    The linear calibration is BP = intercept + slope * PTT (least squares over the tracked beats).
+    '''
+    def __init__(self, window: int = None, halflife: float = None) -> None:
+        assert window is None or halflife is None, 'Use either a window or a halflife'
+        self.window = window
+        self.decay = 0.5 ** (1 / halflife) if halflife else 1.0
+        self.pairs = deque() if window else None
+        self.weight = 0.0
+        self.mean_x, self.mean_y = 0.0, 0.0
+        self.sxx, self.syy, self.sxy = 0.0, 0.0, 0.0
+
+    def update(self, x: float, y: float) -> 'Running_Regression':
+        '''
+        Add the PTT x and BP y of a beat (beats with a missing value are skipped)
+        '''
+        if np.isnan(x) or np.isnan(y):
+            return self
+        self.weight = self.decay * self.weight + 1
+        dx, dy = x - self.mean_x, y - self.mean_y
+        self.mean_x += dx / self.weight
+        self.mean_y += dy / self.weight
+        self.sxx = self.decay * self.sxx + dx * (x - self.mean_x)
+        self.syy = self.decay * self.syy + dy * (y - self.mean_y)
+        self.sxy = self.decay * self.sxy + dx * (y - self.mean_y)
+        if self.pairs is not None:
+            self.pairs.append((x, y))
+            if len(self.pairs) > self.window:
+                self.remove(*self.pairs.popleft())
+        return self
+
+    def remove(self, x: float, y: float) -> None:
+        self.weight -= 1
+        if self.weight == 0:
+            self.mean_x, self.mean_y, self.sxx, self.syy, self.sxy = 0.0, 0.0, 0.0, 0.0, 0.0
+            return
+        dx, dy = x - self.mean_x, y - self.mean_y
+        self.mean_x -= dx / self.weight
+        self.mean_y -= dy / self.weight
+        self.sxx -= dx * (x - self.mean_x)
+        self.syy -= dy * (y - self.mean_y)
+        self.sxy -= dx * (y - self.mean_y)
+
+    @property
+    def corr(self) -> float:
+        denominator = np.sqrt(self.sxx * self.syy)
+        return self.sxy / denominator if denominator > 0 else np.nan
+
+    @property
+    def slope(self) -> float:
+        return self.sxy / self.sxx if self.sxx > 0 else np.nan
+
+    @property
+    def intercept(self) -> float:
+        return self.mean_y - self.slope * self.mean_x
+
+    def predict(self, x: float) -> float:
+        '''
+        BP estimated from a PTT with the current calibration
+        '''
+        return self.intercept + self.slope * x
+
+def track_ptt_bp(beats: pd.DataFrame, ptt: str = 'ptt_r_head_trough', pressure: str = 'bp', window: int = None, halflife: float = None) -> pd.DataFrame:
+    '''
+    Correlation and calibration of a PTT column against a pressure column of the beat table, after every beat
+    Input:
+        beats: pd.DataFrame: The beat table (see src/beat_table.py)
+        ptt: str: The PTT column (e.g. 'ptt_r_trough', 'ptt_r_head_trough')
+        pressure: str: The pressure column ('bp', 'systolic' or 'diastolic')
+        window: int: Sliding window length in beats
+        halflife: float: Halflife of the exponential weighting in beats
+    Output:
+        pd.DataFrame: One row per beat with the running correlation, slope (mmHg / ms) and intercept (mmHg)
+    '''
+    regression = Running_Regression(window, halflife)
+    rows = []
+    for x, y in zip(beats[ptt].to_numpy(dtype=float), beats[pressure].to_numpy(dtype=float)):
+        regression.update(x, y)
+        rows.append((regression.corr, regression.slope, regression.intercept))
+    return pd.DataFrame(rows, columns=['corr', 'slope', 'intercept'], index=beats.index)
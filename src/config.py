@@ -1,3 +1,5 @@
+import copy
+
 class Config:
     # Activities
     activities = {
@@ -15,6 +17,13 @@ class Config:
     }
 
     ecg_filter_type = 'ema'
+    ecg_peak_detector = 'vectorized' # 'loop', 'vectorized' or 'scipy'
+    entropy_reduction = 'sum' # 'sum', 'mean' or 'max' over the channels of IMU / Head PPG
+    dtype = 'float64' # 'float32' halves the memory of every signal from load through detection
+    working_fs = None # e.g. 250 to filter and detect on decimated signals (fiducials are refined back to the full rate), None for full rate
+    outlier_handling = 'clip' # samples outside the 1 % / 98 % quantiles are 'clip'ped or 'interpolate'd in place; 'drop' (the former remove_outliers) shortens every channel by a different amount
+    outlier_z = 5 # BCG / IMU BCG bounds in scaled MADs around the median: their 98 % quantile would cut the J apexes
+    beat_gating = False # drop implausible beats (Beat_Param) before the J-peak, I / K valley and trough searches
 
     class ECG_Param:
         # Bandpass Filter Parameters
@@ -42,6 +51,13 @@ class Config:
         EMA_Param = {
             'span': 10 # alpha = 2 / (span + 1) [Etemadi+11]
         }
+
+        # Streaming Detector Parameters (ECG_Stream)
+        Stream_Param = {
+            'threshold_s': 10, # time constant of the running mean / std of the envelope
+            'threshold_std': 2.5, # causal filtering keeps more noise than sosfiltfilt, hence above the batch 1.5
+            'warmup_s': 1 # no detection until the running statistics settle
+        }
     
     class BCG_Param:
         # Bandpass Filter Parameters
@@ -63,4 +79,58 @@ class Config:
             'span': 10 # alpha = 2 / (span + 1) [Etemadi+11]
         }
 
-        
\ No newline at end of file
+    class Beat_Param:
+        # RR interval plausibility
+        RR_Param = {
+            'min_s': 0.3, # 200 bpm
+            'max_s': 2.0, # 30 bpm
+            'deviation': 0.3, # relative to the median RR of the surrounding beats
+            'beats': 9
+        }
+
+        # Correlation with the median beat (ECG around R)
+        Template_Param = {
+            'lbound': -0.1,
+            'ubound': 0.2,
+            'min_corr': 0.7
+        }
+
+        # J amplitude and R - J latency (robust z-score)
+        J_Param = {
+            'max_z': 4
+        }
+
+        # PTT outliers of the beat table, method None (keep all), 'kmeans' or 'mad'
+        PTT_Param = {
+            'method': None,
+            'n_clusters': 2,
+            'max_z': 3,
+            'max_share': 0.25 # kmeans only rejects clusters this small and max_z away from the main one
+        }
+
+def config_snapshot() -> dict:
+    '''
+    Copy of every Config setting (parameter classes such as ECG_Param become dicts of their settings)
+    Worker processes get the Config of the parent through it: under the spawn start method (the default on macOS) they
+    re-import the defaults instead.
+    '''
+    settings = {}
+    for name, value in vars(Config).items():
+        if name.startswith('_'):
+            continue
+        if isinstance(value, type):
+            value = {key: item for key, item in vars(value).items() if not key.startswith('_')}
+        settings[name] = copy.deepcopy(value)
+    return settings
+
+def apply_config(settings: dict) -> None:
+    '''
+    Set the Config to a config_snapshot
+    '''
+    for name, value in copy.deepcopy(settings).items():
+        target = getattr(Config, name, None)
+        if isinstance(target, type):
+            for key, item in value.items():
+                setattr(target, key, item)
+        else:
+            setattr(Config, name, value)
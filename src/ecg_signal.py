@@ -1,22 +1,35 @@
 import logging
 import pandas as pd
 import numpy as np
-from typing import Any
+from typing import Any, List, Tuple, Union
 from scipy.stats import zscore
+from scipy.signal import sosfilt, sosfilt_zi, lfilter, lfilter_zi, savgol_coeffs, get_window
 
 from src.utils import *
+from src.profiler import profiler
+from src.quantiles import Quantile_Sketch
 
 class ECG_Signal:
-    def __init__(self, raw_ecg_signal: pd.Series, fs: int, logger: logging.Logger, cfg: Any) -> None:
-        self.raw_ecg = remove_outliers(raw_ecg_signal)
+    peak_detectors = {
+        'loop': calculate_peak_indices,
+        'vectorized': calculate_peak_indices_vectorized,
+        'scipy': calculate_peak_indices_scipy
+    }
+
+    def __init__(self, raw_ecg_signal: pd.Series, fs: int, logger: logging.Logger, cfg: Any, working_fs: int = None, outliers: str = 'clip') -> None:
+        # The outlier handling only conditions the input of the filter chain: the R apexes are the top samples of an ECG,
+        # so the peak correction (and the beat quality) search the unclipped signal ('drop' shortens both alike)
+        self.clipped_ecg = clip_outliers(raw_ecg_signal, outliers)
+        self.raw_ecg = self.clipped_ecg if outliers == 'drop' else raw_ecg_signal
         self.fs = fs
         self.logger = logger
         self.cfg = cfg
+        self.decimation = decimation_factor(fs, working_fs)
     
     def __len__(self) -> int:
         return len(self.filtered_ecg)
     
-    def apply_pan_tompkins(self, filter_type: str) -> None:
+    def apply_pan_tompkins(self, filter_type: str, peak_detector: str = 'vectorized') -> None:
         '''
         Apply the Pan-Tompkins algorithm to the ECG signal
         1. Bandpass filter
@@ -26,27 +39,38 @@ class ECG_Signal:
         5. Peak detection
         6. Peak correction
         7. Heart rate calculation
+        With a working rate, steps 1-5 run on the decimated signal (filtered_ecg is at fs / decimation)
+        and the correction maps the peaks back onto the full-rate raw signal.
         '''
 
         self.logger.info(f'Applying Pan-Tompkins algorithm to {self.raw_ecg.name}')
         assert filter_type.lower() in ['ma', 'ema'], 'Filter type must be either "ma" or "ema"'
-        self.filtered_ecg = apply_bp_filter(signal = self.raw_ecg, **self.cfg.BPF_Param, fs=self.fs)
-        self.filtered_ecg[np.abs(zscore(self.filtered_ecg)) > 2] = np.median(self.filtered_ecg)
-        self.filtered_ecg = apply_derivative_filter(signal = self.filtered_ecg, **self.cfg.SavGol_Param)
-        if filter_type.lower() == 'ma':
-            self.filtered_ecg = apply_rolling(self.filtered_ecg, fs=self.fs, **self.cfg.MA_Param)
-        else:
-            self.filtered_ecg = apply_rolling_ema(self.filtered_ecg, **self.cfg.EMA_Param)
+        assert peak_detector.lower() in self.peak_detectors, f'Peak detector must be one of {list(self.peak_detectors)}'
+        n, q = len(self.raw_ecg), self.decimation
+        fs = self.fs // q
+        SavGol_Param, EMA_Param = scale_filter_params(self.cfg.SavGol_Param, self.cfg.EMA_Param, q)
+        with profiler.measure('ECG_Signal.bandpass', n):
+            self.filtered_ecg = apply_bp_filter(signal = decimate_signal(self.clipped_ecg, q), **self.cfg.BPF_Param, fs=fs)
+            self.filtered_ecg[np.abs(zscore(self.filtered_ecg)) > 2] = np.median(self.filtered_ecg)
+        with profiler.measure('ECG_Signal.derivative', n):
+            self.filtered_ecg = apply_derivative_filter(signal = self.filtered_ecg, **SavGol_Param)
+        with profiler.measure(f'ECG_Signal.{filter_type.lower()}', n):
+            if filter_type.lower() == 'ma':
+                self.filtered_ecg = apply_rolling(self.filtered_ecg, fs=fs, **self.cfg.MA_Param)
+            else:
+                self.filtered_ecg = apply_rolling_ema(self.filtered_ecg, **EMA_Param)
         self.filtered_ecg.rename(f'{self.raw_ecg.name} (Averaged)', inplace=True)
         self.filtered_ecg.fillna(0.0, inplace=True)
-        self.filtered_ecg = self.filtered_ecg.apply(shannon_entropy)
-        self.peak_indices = calculate_peak_indices(self.filtered_ecg, fs=self.fs)
-        self.peak_indices_corrected = corrected_peaks(self.raw_ecg, self.peak_indices, self.fs)
+        with profiler.measure('ECG_Signal.entropy', n):
+            self.filtered_ecg = apply_shannon_entropy(self.filtered_ecg)
+        with profiler.measure('ECG_Signal.peak_detection', n):
+            self.peak_indices = [peak * q for peak in self.peak_detectors[peak_detector.lower()](self.filtered_ecg, fs=fs)]
+        with profiler.measure('ECG_Signal.peak_correction', n):
+            self.peak_indices_corrected = corrected_peaks(self.raw_ecg, self.peak_indices, self.fs)
         self.heart_rate = self.__calculate_heart_rate().__round__(1)
 
         # Uncomment to see the difference between the scipy and the custom peak detection
-        # from scipy.signal import find_peaks
-        # self.scipy_peaks = find_peaks(self.filtered_ecg, distance=int(0.2 * self.fs), height=self.filtered_ecg.mean() + 0.5 * self.filtered_ecg.std())[0]
+        # self.scipy_peaks = [peak * q for peak in calculate_peak_indices_scipy(self.filtered_ecg, fs=fs)]
         
     
     def __calculate_heart_rate(self) -> float:
@@ -57,4 +81,208 @@ class ECG_Signal:
         '''
         intervals = np.diff(self.peak_indices_corrected)
 
-        return 60 / (intervals.mean() / self.fs)
\ No newline at end of file
+        return 60 / (intervals.mean() / self.fs)
+
+
+class ECG_Stream:
+    '''
+    Streaming version of ECG_Signal.apply_pan_tompkins
+    The signal is fed in chunks and every stage keeps its state between chunks:
+    0. Optional outlier clipping of the filter input at the 1 % / 98 % quantiles of the signal so far (Quantile_Sketch, bounds refreshed every second)
+    1. Causal bandpass filter (SOS with zi)
+    2. Outlier clamp with running mean / variance
+    3. Derivative filter (Savitzky-Golay coefficients over a ring buffer of the last w - 1 samples)
+    4. Moving average / EMA filter (lfilter with zi)
+    5. Entropy calculation
+    6. Peak detection against an exponentially weighted mean + k * std threshold
+    7. Peak correction on the raw signal
+    8. Instantaneous heart rate
+    A peak is emitted at most distance / 2 + 70 ms (+ filter delay) after it occurred.
+    Clipping (step 0) is off by default: it costs the causal chain a few T-wave detections (about 3 % more peaks than the batch path).
+    '''
+    def __init__(self, fs: int, logger: logging.Logger, cfg: Any, filter_type: str = 'ema', outliers: str = None) -> None:
+        assert filter_type.lower() in ['ma', 'ema'], 'Filter type must be either "ma" or "ema"'
+        assert outliers in [None, 'clip', 'interpolate'], 'Outliers must be None, "clip" or "interpolate" (samples cannot be dropped from a stream)'
+        self.fs = fs
+        self.logger = logger
+        self.cfg = cfg
+        self.distance = int(0.2 * fs) # value based on the refractory period of the human cardiac cells, 200 ms
+        self.delta = int(self.distance / 2)
+        self.correction = int(0.07 * fs)
+        self.warmup = int(cfg.Stream_Param['warmup_s'] * fs)
+        self.position = 0
+
+        # Streaming quantiles for the outlier clipping
+        self.outliers = outliers
+        self.quantiles = Quantile_Sketch()
+        self.bounds, self.bounds_count = None, 0
+
+        # Bandpass filter
+        self.sos = butter_bandpass(**cfg.BPF_Param, fs=fs)
+        self.sos_zi = None
+
+        # Running mean / variance for the outlier clamp
+        self.count, self.mean, self.m2 = 0, 0.0, 0.0
+
+        # Derivative filter, output is delayed by (w - 1) / 2 samples
+        w = cfg.SavGol_Param['w']
+        self.savgol = savgol_coeffs(w, cfg.SavGol_Param['p'], deriv=cfg.SavGol_Param['m'], use='conv')
+        self.savgol_buffer = None
+        self.delay = (w - 1) // 2
+
+        # Moving average / EMA filter
+        if filter_type.lower() == 'ma':
+            assert cfg.MA_Param['rolling_type'] == 'mean', 'Only the rolling mean can be streamed'
+            window = get_window(cfg.MA_Param['win_type'] or 'boxcar', int(cfg.MA_Param['window_ms'] * fs * 1e-3), fftbins=False)
+            self.smooth_ba = (window[::-1] / window.sum(), [1.0])
+        else:
+            alpha = 2 / (cfg.EMA_Param['span'] + 1)
+            self.smooth_ba = ([alpha], [1.0, alpha - 1])
+        self.smooth_zi = None
+
+        # Adaptive threshold (exponentially weighted mean and mean of squares of the envelope)
+        beta = 2 / (cfg.Stream_Param['threshold_s'] * fs + 1)
+        self.threshold_ba = ([beta], [1.0, beta - 1])
+        self.threshold_std = cfg.Stream_Param['threshold_std']
+        self.threshold_zi = None
+
+        # Envelope samples not searched yet and raw samples needed for the correction
+        self.envelope = np.empty(0)
+        self.threshold = np.empty(0)
+        self.envelope_start = 0
+        self.search_start = 0
+        self.raw = np.empty(0)
+        self.raw_start = 0
+        self.pending = []
+
+        self.peak_indices = []
+        self.peak_indices_corrected = []
+        self.heart_rates = []
+
+    def process_chunk(self, chunk: Union[pd.Series, np.ndarray]) -> Tuple[List[int], List[float]]:
+        '''
+        Process the next chunk of the ECG signal
+        Input:
+            chunk: Union[pd.Series, np.ndarray]: The next samples of the signal
+        Output:
+            Tuple[List[int], List[float]]: The corrected R-peaks resolved in this chunk and their instantaneous heart rate (bpm)
+        '''
+        x = np.asarray(chunk, dtype=float)
+        if len(x) == 0:
+            return [], []
+        # As in ECG_Signal, only the input of the filters is clipped: the peak correction searches the unclipped R apexes
+        self.raw = np.concatenate([self.raw, x])
+        clipped = x
+        if self.outliers:
+            self.quantiles.update(x)
+            if self.quantiles.count - self.bounds_count >= self.fs:
+                self.bounds, self.bounds_count = self.quantiles.quantile([0.01, 0.98]), self.quantiles.count
+            # Quantiles of less than a second of signal would clip the first R-peaks themselves
+            if self.bounds is not None:
+                clipped = clip_outliers(x, self.outliers, bounds=self.bounds).to_numpy()
+        y = self.__filter(clipped)
+        self.__append_envelope(calculate_shannon_entropy(y))
+        self.position += len(x)
+        self.__detect(final=False)
+        return self.__emit(final=False)
+
+    def flush(self) -> Tuple[List[int], List[float]]:
+        '''
+        Resolve the peaks still waiting for samples at the end of the stream
+        Output:
+            Tuple[List[int], List[float]]: The remaining corrected R-peaks and their instantaneous heart rate (bpm)
+        '''
+        self.__detect(final=True)
+        return self.__emit(final=True)
+
+    @property
+    def heart_rate(self) -> float:
+        '''
+        Calculate the heart rate from the corrected peak indices seen so far
+        Output:
+            float: The heart rate
+        '''
+        intervals = np.diff(self.peak_indices_corrected)
+        return (60 / (intervals.mean() / self.fs)).__round__(1) if len(intervals) else np.nan
+
+    def __filter(self, x: np.ndarray) -> np.ndarray:
+        if self.sos_zi is None:
+            self.sos_zi = sosfilt_zi(self.sos) * x[0]
+        y, self.sos_zi = sosfilt(self.sos, x, zi=self.sos_zi)
+
+        # Merge the chunk into the running mean / variance (Chan et al.) and clamp the outliers
+        n, mean, m2 = len(y), y.mean(), ((y - y.mean()) ** 2).sum()
+        total = self.count + n
+        diff = mean - self.mean
+        self.mean += diff * n / total
+        self.m2 += m2 + diff ** 2 * self.count * n / total
+        self.count = total
+        std = np.sqrt(self.m2 / self.count)
+        if std > 0:
+            y[np.abs(y - self.mean) > 2 * std] = self.mean
+
+        if self.savgol_buffer is None:
+            self.savgol_buffer = np.full(len(self.savgol) - 1, y[0])
+        buffered = np.concatenate([self.savgol_buffer, y])
+        y = np.convolve(buffered, self.savgol, mode='valid')
+        self.savgol_buffer = buffered[len(buffered) - len(self.savgol) + 1:]
+
+        b, a = self.smooth_ba
+        if self.smooth_zi is None:
+            self.smooth_zi = lfilter_zi(b, a) * y[0]
+        y, self.smooth_zi = lfilter(b, a, y, zi=self.smooth_zi)
+        return y
+
+    def __append_envelope(self, envelope: np.ndarray) -> None:
+        b, a = self.threshold_ba
+        if self.threshold_zi is None:
+            self.threshold_zi = [lfilter_zi(b, a) * envelope[0], lfilter_zi(b, a) * envelope[0] ** 2]
+        mean, self.threshold_zi[0] = lfilter(b, a, envelope, zi=self.threshold_zi[0])
+        square, self.threshold_zi[1] = lfilter(b, a, envelope ** 2, zi=self.threshold_zi[1])
+        threshold = mean + self.threshold_std * np.sqrt(np.maximum(square - mean ** 2, 0))
+        threshold[:max(0, self.warmup - self.position)] = np.inf
+        self.envelope = np.concatenate([self.envelope, envelope])
+        self.threshold = np.concatenate([self.threshold, threshold])
+
+    def __detect(self, final: bool) -> None:
+        end = self.envelope_start + len(self.envelope)
+        while self.search_start < end:
+            offset = self.search_start - self.envelope_start
+            above = np.flatnonzero(self.envelope[offset:] >= self.threshold[offset:])
+            if len(above) == 0:
+                self.search_start = end
+                break
+            crossing = self.search_start + above[0]
+            if crossing + self.delta > end and not final:
+                self.search_start = crossing
+                break
+            window = self.envelope[crossing - self.envelope_start:min(crossing + self.delta, end) - self.envelope_start]
+            peak = crossing + int(np.argmax(window))
+            self.peak_indices.append(peak - self.delay)
+            self.pending.append(peak - self.delay)
+            self.search_start = peak + self.distance
+
+        # Keep only the envelope that has not been searched yet
+        keep = min(self.search_start, end) - self.envelope_start
+        self.envelope, self.threshold = self.envelope[keep:], self.threshold[keep:]
+        self.envelope_start += keep
+
+    def __emit(self, final: bool) -> Tuple[List[int], List[float]]:
+        ready = [peak for peak in self.pending if final or peak + self.correction <= self.position]
+        self.pending = self.pending[len(ready):]
+        peaks, heart_rates = [], []
+        if ready:
+            corrected = calculate_windowed_extrema(self.raw, np.array(ready) - self.raw_start, self.fs, -0.07, 0.07) + self.raw_start
+            for peak in corrected.tolist():
+                previous = self.peak_indices_corrected[-1] if self.peak_indices_corrected else None
+                heart_rates.append(60 * self.fs / (peak - previous) if previous is not None and peak > previous else np.nan)
+                peaks.append(peak)
+                self.peak_indices_corrected.append(peak)
+        self.heart_rates.extend(heart_rates)
+
+        # Keep only the raw samples the next corrections can reach
+        oldest = min(self.pending + [self.search_start - self.delay]) - self.correction
+        keep = min(max(oldest - self.raw_start, 0), len(self.raw))
+        self.raw = self.raw[keep:]
+        self.raw_start += keep
+        return peaks, heart_rates
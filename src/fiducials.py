@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+from typing import List, Union
+
+class Fiducial_Markers:
+    '''
+    Sample indices of one kind of fiducial point (R-peaks, J-peaks, troughs, ...) on a signal of a given length
+    Stored as a sorted int32 array instead of a full-length boolean Series; the boolean mask is built on demand.
+    '''
+    def __init__(self, indices: Union[List[int], np.ndarray], length: int, name: str = None) -> None:
+        self.indices = np.unique(np.asarray(indices, dtype=np.int32))
+        assert len(self.indices) == 0 or (self.indices[0] >= 0 and self.indices[-1] < length), 'Indices must lie within the signal'
+        self.length = length
+        self.name = name
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __iter__(self):
+        return iter(self.indices.tolist())
+
+    def __repr__(self) -> str:
+        return f'Fiducial_Markers(name={self.name!r}, events={len(self.indices)}, length={self.length})'
+
+    def __getitem__(self, window: slice) -> 'Fiducial_Markers':
+        '''
+        Restrict the markers to a window of the signal, indices become relative to the window start
+        '''
+        assert isinstance(window, slice) and window.step in (None, 1), 'Only contiguous slices are supported'
+        start, stop, _ = window.indices(self.length)
+        return Fiducial_Markers(self.between(start, stop) - start, max(stop - start, 0), self.name)
+
+    def rename(self, name: str) -> 'Fiducial_Markers':
+        return Fiducial_Markers(self.indices, self.length, name)
+
+    def between(self, start: int, stop: int) -> np.ndarray:
+        '''
+        Indices in [start, stop), found by binary search
+        '''
+        lo, hi = np.searchsorted(self.indices, [start, stop])
+        return self.indices[lo:hi]
+
+    def count(self, start: int, stop: int) -> int:
+        lo, hi = np.searchsorted(self.indices, [start, stop])
+        return int(hi - lo)
+
+    def mask(self) -> np.ndarray:
+        y = np.zeros(self.length, dtype=bool)
+        y[self.indices] = True
+        return y
+
+    def to_series(self) -> pd.Series:
+        return pd.Series(self.mask(), name=self.name)
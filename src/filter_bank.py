@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+from typing import Any, List, Union
+
+from src.utils import *
+
+class Filter_Bank:
+    '''
+    Bandpass -> EMA -> derivative chain applied to every channel of a (samples x channels) block at once
+    The bandpass sections come from the cached butter_bandpass, every stage runs along axis 0 on NumPy arrays.
+    For a signal decimated by q (fs is then the decimated rate), the EMA span and derivative window are scaled to the same time span.
+    The pipeline itself filters one channel per call on purpose: BCG, IMU BCG, finger and head PPG are separate stages
+    (Recording.outputs) that are cached, swept and run concurrently on their own (Recording.run), and the IMU axes and head
+    PPG channels are reduced to one signal before filtering. A block of aligned channels is filtered in one pass, e.g. for
+    analyses of several raw channels, with the same output as filtering them one by one.
+    '''
+    stages = ['bandpass', 'ema', 'derivative']
+
+    def __init__(self, fs: int, cfg: Any, decimation: int = 1) -> None:
+        self.fs = fs
+        self.cfg = cfg
+        self.sos = butter_bandpass(**cfg.BPF_Param, fs=fs)
+        self.SavGol_Param, self.EMA_Param = scale_filter_params(cfg.SavGol_Param, cfg.EMA_Param, decimation)
+
+    def apply(self, signal: Union[pd.Series, pd.DataFrame, np.ndarray], stages: List[str] = None) -> np.ndarray:
+        '''
+        Apply the filter chain to the signal
+        Input:
+            signal: Union[pd.Series, pd.DataFrame, np.ndarray]: The input signal, (n_samples,) or (n_samples, n_channels)
+            stages: List[str]: The stages to apply, in chain order (all by default)
+        Output:
+            np.ndarray: The filtered signal, same shape as the input
+        '''
+        stages = stages or self.stages
+        assert all(stage in self.stages for stage in stages), f'Stages must be in {self.stages}'
+        y = as_float_array(signal)
+        if 'bandpass' in stages:
+            y = sosfiltfilt(self.sos.astype(y.dtype, copy=False), y, axis=0)
+        if 'ema' in stages:
+            y = ema_filter(y, **self.EMA_Param, axis=0)
+        if 'derivative' in stages:
+            p, w, m = self.SavGol_Param['p'], self.SavGol_Param['w'], self.SavGol_Param['m']
+            y = savgol_filter(y, polyorder=p, window_length=w, deriv=m, delta=self.SavGol_Param.get('delta', 1.0), axis=0)
+        return y
@@ -0,0 +1,20 @@
+import pandas as pd
+import numpy as np
+from logging import Logger
+from typing import Any
+
+from src.bcg_signal import BCG_Signal
+from src.profiler import profiler
+
+class IMU_Signal(BCG_Signal):
+    '''
+    Accelerometer BCG: the magnitude of the 3-axis block, processed like the force plate BCG (Config.BCG_Param chain,
+    J-peaks conditioned on the R-peaks, I / K valleys around them)
+    With gravity on the sensor, the magnitude follows the acceleration along the gravity axis, so the BCG keeps its sign
+    whatever the orientation of the device.
+    '''
+    def __init__(self, raw_imu: pd.DataFrame, fs: int, logger: Logger, cfg: Any, working_fs: int = None, outliers: str = 'clip', outlier_z: float = 5) -> None:
+        with profiler.measure('IMU_Signal.magnitude', len(raw_imu)):
+            axes = raw_imu.to_numpy()
+            magnitude = pd.Series(np.sqrt(np.einsum('ij,ij->i', axes, axes)), name='IMU Magnitude')
+        super().__init__(magnitude, fs, logger, cfg, working_fs, outliers, outlier_z)
@@ -4,25 +4,32 @@ from logging import Logger
 from typing import Any, List
 
 from src.utils import *
+from src.filter_bank import Filter_Bank
+from src.profiler import profiler
 
 class PPG_Signal:
-    def __init__(self, raw_signal: pd.Series, fs: int, logger: Logger, cfg: Any) -> None:
-        self.raw_ppg = remove_outliers(raw_signal)
+    def __init__(self, raw_signal: pd.Series, fs: int, logger: Logger, cfg: Any, working_fs: int = None, outliers: str = 'clip') -> None:
+        self.raw_ppg = clip_outliers(raw_signal, outliers)
         self.logger = logger
         self.fs = fs
         self.cfg = cfg
+        self.decimation = decimation_factor(fs, working_fs)
     
     def process(self, peak_indices: List, r_peaks) -> float:
-        self.filtered_ppg = apply_bp_filter(signal=self.raw_ppg, fs = self.fs, **self.cfg.BPF_Param).rename(f'{self.raw_ppg.name} (Filtered)')
-        self.filtered_ppg = apply_rolling_ema(self.filtered_ppg, **self.cfg.EMA_Param).rename(f'{self.filtered_ppg.name} (Smoothed)')
-        self.filtered_ppg = apply_derivative_filter(self.filtered_ppg, **self.cfg.SavGol_Param).rename(f'{self.filtered_ppg.name} (Derivative)')
-        self.troughs = calculate_peak_indices_conditioned(self.filtered_ppg, self.fs, peak_indices[1][:-1], lbound=0.01, ubound=0.2)
-        self.ptts = np.array(self.calculate_ptts(self.troughs, r_peaks)) * 1000 / self.fs # in ms
+        # With a working rate, filtered_ppg is at fs / decimation and the troughs are refined back to full-rate indices
+        n, q = len(self.raw_ppg), self.decimation
+        with profiler.measure('PPG_Signal.filter', n):
+            filtered = Filter_Bank(self.fs // q, self.cfg, q).apply(decimate_signal(self.raw_ppg, q))
+            self.filtered_ppg = pd.Series(filtered, name=f'{self.raw_ppg.name} (Filtered) (Smoothed) (Derivative)')
+        with profiler.measure('PPG_Signal.troughs', n):
+            troughs = calculate_peak_indices_conditioned(self.filtered_ppg, self.fs // q, np.asarray(peak_indices[1][:-1]) // q, lbound=0.01, ubound=0.2)
+            self.troughs = np.minimum(refine_indices(self.filtered_ppg, troughs, q), n - 1).tolist()
+        with profiler.measure('PPG_Signal.ptt', n):
+            self.ptts = np.array(self.calculate_ptts(self.troughs, r_peaks)) * 1000 / self.fs # in ms
         self.avg_ptt = np.mean(self.ptts)
         return self.avg_ptt
     
     def calculate_ptts(self, troughs, r_peaks):
-        ptts = []
-        for i in range(len(troughs)):
-            ptts.append(troughs[i] - r_peaks[i])
-        return ptts
\ No newline at end of file
+        # Pairs by position, see src/beat_table.py for PTTs matched beat by beat
+        n = min(len(troughs), len(r_peaks))
+        return np.asarray(troughs[:n]) - np.asarray(r_peaks[:n])
\ No newline at end of file
@@ -0,0 +1,103 @@
+import json
+import time
+import tracemalloc
+import functools
+import threading
+import pandas as pd
+from contextlib import contextmanager
+from typing import Callable, List
+
+class Profiler:
+    '''
+    Record wall time, CPU time, peak allocated memory and input sample count of the processing stages
+    Disabled by default; a disabled measure() only checks a flag, so the instrumentation can stay in place.
+    Stages can be nested (e.g. ECG_Signal steps inside Recording.process_ecg), peak memory is tracked per stage.
+    Every thread has its own stage stack, so stages run concurrently (Recording.run) keep their parents; their peak
+    memory is then that of the whole process while they ran.
+    '''
+    def __init__(self) -> None:
+        self.enabled = False
+        self.memory = False
+        self.records = []
+        self.threads = threading.local()
+
+    def enable(self, memory: bool = True) -> None:
+        '''
+        Start recording (memory=True also traces allocations with tracemalloc, which slows Python code down)
+        '''
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self) -> None:
+        self.enabled = False
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.memory = False
+
+    @property
+    def stack(self) -> List[dict]:
+        if not hasattr(self.threads, 'stack'):
+            self.threads.stack = []
+        return self.threads.stack
+
+    def clear(self) -> None:
+        self.records = []
+
+    @contextmanager
+    def measure(self, stage: str, samples: int = None):
+        if not self.enabled:
+            yield
+            return
+        frame = {'stage': stage, 'parent': self.stack[-1]['stage'] if self.stack else None, 'samples': samples}
+        if self.memory:
+            # Fold the peak so far into the enclosing stages before resetting it for this one
+            current, peak = tracemalloc.get_traced_memory()
+            for outer in self.stack:
+                outer['peak'] = max(outer['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['start_memory'], frame['peak'] = current, current
+        self.stack.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            self.stack.pop()
+            record = {'stage': stage, 'parent': frame['parent'], 'samples': samples, 'wall_s': wall, 'cpu_s': cpu, 'peak_mb': None}
+            if self.memory:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                for outer in self.stack:
+                    outer['peak'] = max(outer['peak'], peak)
+                record['peak_mb'] = (peak - frame['start_memory']) / 2 ** 20
+            self.records.append(record)
+
+    def report(self) -> pd.DataFrame:
+        '''
+        Output:
+            pd.DataFrame: One row per measured stage (in completion order), with throughput in samples per second
+        '''
+        return self.to_frame(self.records)
+
+    @staticmethod
+    def to_frame(records: List[dict]) -> pd.DataFrame:
+        report = pd.DataFrame(records, columns=['stage', 'parent', 'samples', 'wall_s', 'cpu_s', 'peak_mb'])
+        report['samples_per_s'] = report['samples'] / report['wall_s']
+        return report
+
+    def to_json(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.records, f, indent=2)
+
+profiler = Profiler()
+
+def profiled(method: Callable) -> Callable:
+    '''
+    Measure a Recording.process_* method, with the session length as the sample count
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with profiler.measure(f'{type(self).__name__}.{method.__name__}', len(self.recording)):
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,46 @@
+import numpy as np
+from typing import List, Union
+
+class Quantile_Sketch:
+    '''
+    Approximate quantiles of a stream of chunks in bounded memory (a KLL-style compactor hierarchy)
+    Every level keeps at most capacity values, each standing for 2 ** level samples. A full level is sorted and every
+    other value (from a random offset) moves one level up, so the memory grows with log(n / capacity) and the rank
+    error stays around log2(n / capacity) / capacity of the samples seen.
+    '''
+    def __init__(self, capacity: int = 4096, seed: int = 0) -> None:
+        self.capacity = capacity
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, chunk: Union[np.ndarray, List[float]]) -> 'Quantile_Sketch':
+        values = np.asarray(chunk, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        level = 0
+        while level < len(self.levels) and len(self.levels[level]) > self.capacity:
+            ordered = np.sort(self.levels[level])
+            # An even number of values is compacted, the odd one out stays on this level
+            even = len(ordered) - len(ordered) % 2
+            kept, promoted = ordered[even:], ordered[:even]
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted[self.rng.integers(2)::2]])
+            self.levels[level] = kept
+            level += 1
+        return self
+
+    def quantile(self, q: Union[float, List[float]]) -> np.ndarray:
+        '''
+        Approximate quantile(s) of every sample seen so far (linear interpolation between the weighted values like np.quantile)
+        '''
+        values = np.concatenate(self.levels)
+        assert len(values) > 0, 'No samples seen yet'
+        weights = np.concatenate([np.full(len(level), 2.0 ** i) for i, level in enumerate(self.levels)])
+        order = np.argsort(values)
+        values, weights = values[order], weights[order]
+        # Position of every value in the sorted stream (centre of the samples it stands for), scaled to [0, 1]
+        positions = (np.cumsum(weights) - weights / 2) / weights.sum()
+        return np.interp(q, positions, values)
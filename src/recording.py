@@ -1,92 +1,335 @@
 import pandas as pd
-from typing import List, Union
+from typing import Any, List, Union
 import numpy as np
 import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from matplotlib import pyplot as plt
 
-from src.config import Config
+from src.config import Config, config_snapshot, apply_config
 from src.utils import *
+from src.profiler import profiled
+from src.result_cache import Result_Cache, cached, hash_frame, hash_parameters, hash_key
+from src.fiducials import Fiducial_Markers
 from utils import plot_signal
 
 class Recording:
+    # Columns used by the process_* methods (regex patterns, see utils.load_session)
+    columns = ['session', 'chest sternum ECG', 'IMU', 'BCG', 'BP', 'PPG', 'finapres systolic', 'finapres diastolic']
+
+    # Attributes set by each process_* method. Reading one of them before it exists runs the method that sets it,
+    # and the attributes that method reads pull in the stages it depends on, so every stage runs at most once.
+    outputs = {
+        'process_ecg': ['ecg', 'r_peaks', 'r_peaks_corrected'],
+        'process_imu': ['imu', 'imu_processed', 'imu_z', 'imu_y', 'imu_x'],
+        'process_imu_bcg': ['imu_bcg', 'imu_IJK', 'imu_J_peaks', 'imu_I_valleys', 'imu_K_valleys'],
+        'process_beat_quality': ['beat_quality', 'good_r_peaks'],
+        'process_bcg': ['bcg', 'IJK', 'J_peaks', 'I_valleys', 'K_valleys'],
+        'process_bp': ['bp'],
+        'process_ppg': ['ppg', 'finger_avg_ptt', 'troughs'],
+        'process_systolic_p': ['systolic_p'],
+        'process_diastolic_p': ['diastolic_p'],
+        'process_head_ppg': ['processed_head_ppg', 'head_avg_ptt'],
+        'process_beats': ['beats']
+    }
+    producers = {output: stage for stage, outputs in outputs.items() for output in outputs}
+
+    # Config attributes read by each stage and the stages whose outputs it reads (see stage_key and run):
+    # a parameter change only invalidates the stages that use it and the ones downstream of them
+    parameters = {
+        'process_ecg': ['ECG_Param', 'ecg_filter_type', 'ecg_peak_detector', 'working_fs', 'outlier_handling'],
+        'process_imu': ['entropy_reduction'],
+        'process_beat_quality': ['beat_gating', 'Beat_Param'],
+        'process_imu_bcg': ['BCG_Param', 'working_fs', 'outlier_handling', 'outlier_z', 'beat_gating'],
+        'process_bcg': ['BCG_Param', 'working_fs', 'outlier_handling', 'outlier_z', 'beat_gating'],
+        'process_ppg': ['BCG_Param', 'working_fs', 'outlier_handling'],
+        'process_head_ppg': ['BCG_Param', 'working_fs', 'outlier_handling', 'entropy_reduction'],
+        'process_bp': [],
+        'process_systolic_p': [],
+        'process_diastolic_p': [],
+        'process_beats': ['Beat_Param']
+    }
+    dependencies = {
+        'process_ecg': [],
+        'process_imu': [],
+        'process_beat_quality': ['process_ecg'],
+        'process_imu_bcg': ['process_ecg', 'process_imu', 'process_beat_quality'],
+        'process_bcg': ['process_ecg', 'process_beat_quality'],
+        'process_ppg': ['process_ecg', 'process_beat_quality', 'process_bcg'],
+        'process_head_ppg': ['process_ecg', 'process_beat_quality', 'process_bcg'],
+        'process_bp': [],
+        'process_systolic_p': [],
+        'process_diastolic_p': [],
+        'process_beats': ['process_ecg', 'process_imu', 'process_beat_quality', 'process_bcg', 'process_imu_bcg', 'process_ppg', 'process_head_ppg', 'process_bp', 'process_systolic_p', 'process_diastolic_p']
+    }
+
     def __init__(
                 self, 
                 recording: pd.DataFrame, 
                 logger: logging.Logger,
                 session: int,
-                fs: int = 2000) -> None:
+                fs: int = 2000,
+                cache: Result_Cache = None) -> None:
         self.logger = logger
         self.fs = fs
+        self.cache = cache
+        self.content_hash = None
+        self.stage_keys = {}
         assert session in Config.activities.keys(), 'Session must be an integer between 0 and 10'
         self.session = session
-        self.recording = recording[recording['session'] == self.session]
-        self.recording.reset_index(drop=True, inplace=True)
+        # A frame holding only this session (e.g. from utils.iter_sessions) is used without copying it
+        in_session = recording['session'] == self.session
+        self.recording = recording if in_session.all() else recording[in_session]
+        if not self.recording.index.equals(pd.RangeIndex(len(self.recording))):
+            self.recording = self.recording.reset_index(drop=True)
+        # Keep every signal in Config.dtype through filtering and detection
+        signals = self.recording.select_dtypes('floating').columns
+        self.recording = self.recording.astype({column: Config.dtype for column in signals}, copy=False)
         self.state = Config.activities[self.session]
         self.logger.info(f'Processing recording for session {self.session} ({self.state})')
 
+    def __getattr__(self, name: str) -> Any:
+        stage = Recording.producers.get(name)
+        if stage is None:
+            raise AttributeError(f"'Recording' object has no attribute '{name}'")
+        self.logger.info(f'{name} requested, running {stage} for session {self.session} ({self.state})')
+        getattr(self, stage)()
+        return object.__getattribute__(self, name)
+
+    def stage_key(self, stage: str) -> str:
+        '''
+        Cache key of a stage: hash of the session data, the sampling rate, the Config parameters of the stage and the keys of the stages it depends on
+        '''
+        if stage not in self.stage_keys:
+            if self.content_hash is None:
+                self.content_hash = hash_frame(self.recording)
+            self.stage_keys[stage] = hash_key(
+                Result_Cache.version, stage, self.content_hash, self.session, self.fs,
+                hash_parameters(Recording.parameters[stage]), [self.stage_key(dependency) for dependency in Recording.dependencies[stage]]
+            )
+        return self.stage_keys[stage]
+
+    def run(self, stages: List[str] = None, backend: str = 'thread', max_workers: int = None) -> 'Recording':
+        '''
+        Run stages and the stages they depend on, each one as soon as its dependencies (Recording.dependencies) are done
+        Stages that do not depend on each other (e.g. BCG, IMU and BP after the ECG, then finger and head PPG after the BCG)
+        run at the same time, so the latency approaches the longest dependency chain instead of the sum of the stages.
+        The stages compute the same thing as when they run one after another, so the outputs are identical.
+        Input:
+            stages: List[str]: The process_* methods to run (all of them by default), stages already done are skipped
+            backend: str: 'thread' (the filters and NumPy kernels release the GIL), 'process' (every stage runs in a worker
+                process on a copy of the inputs it reads, with a snapshot of the Config at the time of the call) or None (serial)
+            max_workers: int: The number of threads / processes (the executor default if None)
+        Output:
+            Recording: self, with the outputs of the stages set
+        '''
+        assert backend in [None, 'thread', 'process'], 'Backend must be None, "thread" or "process"'
+        stages = list(Recording.outputs) if stages is None else stages
+        # The dependency lists include indirect dependencies
+        needed = set(stages) | {dependency for stage in stages for dependency in Recording.dependencies[stage]}
+        waiting = [stage for stage in Recording.outputs if stage in needed and not self.done(stage)]
+        if self.cache is not None:
+            # Compute the keys (and the session hash) once here instead of in concurrent stages
+            for stage in waiting:
+                self.stage_key(stage)
+        if backend is None:
+            for stage in sorted(waiting, key=lambda stage: len(Recording.dependencies[stage])):
+                getattr(self, stage)()
+            return self
+        if backend == 'thread':
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            # The session data is sent once per worker instead of once per stage
+            executor = ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(self.recording, config_snapshot()))
+        with executor as pool:
+            running = {}
+            while waiting or running:
+                blocked = set(waiting) | set(running.values())
+                for stage in [stage for stage in waiting if blocked.isdisjoint(Recording.dependencies[stage])]:
+                    waiting.remove(stage)
+                    if backend == 'thread':
+                        running[pool.submit(getattr(self, stage))] = stage
+                    else:
+                        running[pool.submit(run_stage, self.stage_inputs(stage), stage)] = stage
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    values = future.result()
+                    if backend == 'process':
+                        for name, value in values.items():
+                            setattr(self, name, value)
+        self.logger.info(f'{len(needed)} stages done for session {self.session} ({self.state})')
+        return self
+
+    def done(self, stage: str) -> bool:
+        return all(name in self.__dict__ for name in Recording.outputs[stage])
+
+    def stage_inputs(self, stage: str) -> dict:
+        '''
+        Attributes of the recording a stage can read in a worker process: all but the session data (see init_worker) and the
+        outputs of the stages it does not depend on
+        '''
+        others = {name for other, names in Recording.outputs.items() if other != stage and other not in Recording.dependencies[stage] for name in names}
+        others.add('recording')
+        return {name: value for name, value in self.__dict__.items() if name not in others}
+
+    @property
+    def heart_rate(self) -> float:
+        return self.ecg.heart_rate
+
+    @property
+    def IJK_fitted(self) -> pd.DataFrame:
+        return pd.DataFrame({markers.name: markers.mask() for markers in [self.I_valleys, self.J_peaks, self.K_valleys]})
+
+    @profiled
+    @cached
     def process_ecg(self) -> None:
         from src.ecg_signal import ECG_Signal
-        raw_data = self.recording['chest sternum ECG'].copy()
-        self.ecg = ECG_Signal(raw_data, logger=self.logger, fs=self.fs, cfg=Config.ECG_Param)
-        self.ecg.apply_pan_tompkins(Config.ecg_filter_type)
+        raw_data = self.recording['chest sternum ECG']
+        self.ecg = ECG_Signal(raw_data, logger=self.logger, fs=self.fs, cfg=Config.ECG_Param, working_fs=Config.working_fs, outliers=Config.outlier_handling)
+        self.ecg.apply_pan_tompkins(Config.ecg_filter_type, Config.ecg_peak_detector)
         self.logger.info(f'ECG signal processed for session {self.session} ({self.state})')
-        self.r_peaks = fit_to_index(self.ecg.peak_indices, self.ecg.raw_ecg).rename('R-Peaks')
-        self.r_peaks_corrected = fit_to_index(self.ecg.peak_indices_corrected, self.ecg.raw_ecg).rename('R-Peaks Corrected')
+        self.r_peaks = Fiducial_Markers(self.ecg.peak_indices, len(self.ecg.raw_ecg), 'R-Peaks')
+        self.r_peaks_corrected = Fiducial_Markers(self.ecg.peak_indices_corrected, len(self.ecg.raw_ecg), 'R-Peaks Corrected')
         # Uncomment to see the difference between the scipy and the custom peak detection (uncomment in ecg_signal.py as well)
-        # self.r_peaks_scipy = fit_to_index(self.ecg.scipy_peaks, self.ecg.raw_ecg).rename('R-Peaks Scipy')
+        # self.r_peaks_scipy = Fiducial_Markers(self.ecg.scipy_peaks, len(self.ecg.raw_ecg), 'R-Peaks Scipy')
         return self
     
+    @profiled
+    @cached
     def process_imu(self) -> None:
-        self.imu = pd.Series(self.recording.filter(regex='IMU').values.tolist()).rename('IMU (Z, Y, X)')
-        self.imu_processed = self.imu.apply(shannon_entropy).rename('IMU Entropy')
-        self.imu_z = self.imu.apply(lambda x: x[0]).rename('IMU Z')
-        self.imu_y = self.imu.apply(lambda x: x[1]).rename('IMU Y')
-        self.imu_x = self.imu.apply(lambda x: x[2]).rename('IMU X')
+        self.imu = self.recording.filter(regex='IMU')
+        self.imu_processed = apply_shannon_entropy(self.imu, Config.entropy_reduction).rename('IMU Entropy')
+        # Views on the columns of the block, not copies
+        self.imu_z = self.imu.iloc[:,0].rename('IMU Z', copy=False)
+        self.imu_y = self.imu.iloc[:,1].rename('IMU Y', copy=False)
+        self.imu_x = self.imu.iloc[:,2].rename('IMU X', copy=False)
         self.logger.info(f'IMU values stored for session {self.session} ({self.state})')
         return self
+
+    @profiled
+    @cached
+    def process_beat_quality(self) -> None:
+        from src.beat_quality import ecg_beat_quality
+        self.beat_quality = ecg_beat_quality(self.ecg.raw_ecg, self.ecg.peak_indices_corrected, self.fs, Config.Beat_Param)
+        self.good_r_peaks = self.beat_quality['R'].to_numpy()[self.beat_quality['ok'].to_numpy()]
+        self.logger.info(f'Beat quality scored for session {self.session} ({self.state}): {len(self.good_r_peaks)} of {len(self.beat_quality)} beats kept')
+        return self
+
+    def gated_r_peaks(self) -> tuple:
+        '''
+        R-peaks and J-peak outlier limit to give to BCG_Signal.process: every beat without Config.beat_gating, the ones passing the quality checks with it
+        '''
+        if not Config.beat_gating:
+            return self.ecg.peak_indices_corrected, None
+        return self.good_r_peaks, Config.Beat_Param.J_Param['max_z']
+
+    @profiled
+    @cached
+    def process_imu_bcg(self) -> None:
+        from src.imu_signal import IMU_Signal
+        self.imu_bcg = IMU_Signal(self.imu, fs=self.fs, logger=self.logger, cfg=Config.BCG_Param, working_fs=Config.working_fs, outliers=Config.outlier_handling, outlier_z=Config.outlier_z)
+        I_valleys, J_peaks, K_valleys = self.imu_bcg.process(*self.gated_r_peaks())
+        self.imu_IJK = [I_valleys, J_peaks, K_valleys]
+        self.imu_J_peaks = Fiducial_Markers(J_peaks, len(self.imu_bcg.raw_bcg), 'IMU J')
+        self.imu_I_valleys = Fiducial_Markers(I_valleys, len(self.imu_bcg.raw_bcg), 'IMU I')
+        self.imu_K_valleys = Fiducial_Markers(K_valleys, len(self.imu_bcg.raw_bcg), 'IMU K')
+        self.logger.info(f'BCG (IMU) processed for session {self.session} ({self.state})')
+        return self
     
+    @profiled
+    @cached
     def process_bcg(self) -> None:
         from src.bcg_signal import BCG_Signal
         raw_data = self.recording.filter(regex='BCG').iloc[:,0].rename('Force Plate BCG')
-        self.bcg = BCG_Signal(raw_data, fs=self.fs, logger=self.logger, cfg=Config.BCG_Param)
+        self.bcg = BCG_Signal(raw_data, fs=self.fs, logger=self.logger, cfg=Config.BCG_Param, working_fs=Config.working_fs, outliers=Config.outlier_handling, outlier_z=Config.outlier_z)
         self.logger.info(f'BCG (Force Plate) values stored for session {self.session} ({self.state})')
-        I_valleys, J_peaks, K_valleys = self.bcg.process(self.ecg.peak_indices_corrected)
+        I_valleys, J_peaks, K_valleys = self.bcg.process(*self.gated_r_peaks())
         self.IJK = [I_valleys, J_peaks, K_valleys]
-        self.J_peaks = fit_to_index(J_peaks,self.bcg.raw_bcg).rename('J')
-        self.I_valleys = fit_to_index(I_valleys,self.bcg.raw_bcg).rename('I')
-        self.K_valleys = fit_to_index(K_valleys,self.bcg.raw_bcg).rename('K')
-        self.IJK_fitted = pd.concat([self.I_valleys, self.J_peaks, self.K_valleys], axis=1)
+        self.J_peaks = Fiducial_Markers(J_peaks, len(self.bcg.raw_bcg), 'J')
+        self.I_valleys = Fiducial_Markers(I_valleys, len(self.bcg.raw_bcg), 'I')
+        self.K_valleys = Fiducial_Markers(K_valleys, len(self.bcg.raw_bcg), 'K')
         return self
 
+    @profiled
     def process_bp(self) -> None:
         self.bp = self.recording.filter(regex='BP').iloc[:,0].rename('Blood Pressure')
         self.logger.info(f'BP values stored for session {self.session} ({self.state})')
         return self
     
+    @profiled
+    @cached
     def process_ppg(self) -> None:
         from src.ppg_signal import PPG_Signal
         self.ppg = self.recording.filter(regex='PPG').iloc[:,0].rename('PPG')
         self.logger.info(f'PPG values stored for session {self.session} ({self.state})')
-        self.ppg = PPG_Signal(self.ppg, self.fs, self.logger, Config.BCG_Param)
-        self.finger_avg_ptt = self.ppg.process(self.IJK, self.ecg.peak_indices_corrected)
-        self.troughs = fit_to_index(self.ppg.troughs, self.ppg.filtered_ppg).rename('Troughs')
+        self.ppg = PPG_Signal(self.ppg, self.fs, self.logger, Config.BCG_Param, Config.working_fs, Config.outlier_handling)
+        self.finger_avg_ptt = self.ppg.process(self.IJK, self.bcg.r_peaks)
+        self.troughs = Fiducial_Markers(self.ppg.troughs, len(self.ppg.raw_ppg), 'Troughs')
         return self
     
+    @profiled
     def process_systolic_p(self) -> None:
         self.systolic_p = self.recording['finapres systolic']
         self.logger.info(f'Systolic Pressure values stored for session {self.session} ({self.state})')
         return self
     
+    @profiled
     def process_diastolic_p(self) -> None:
         self.diastolic_p = self.recording['finapres diastolic']
         self.logger.info(f'Diastolic Pressure values stored for session {self.session} ({self.state})')
         return self
     
+    @profiled
+    @cached
     def process_head_ppg(self) -> None:
         from src.ppg_signal import PPG_Signal
-        raw_data = pd.Series(self.recording.filter(regex='head forehead PPG').values.tolist()).rename('Head PPG (IR, R, G)')
+        raw_data = self.recording.filter(regex='head forehead PPG')
         self.logger.info(f'Head PPG values stored for session {self.session} ({self.state})')
-        self.processed_head_ppg = raw_data.apply(shannon_entropy).rename('Head PPG Entropy')
-        self.processed_head_ppg = PPG_Signal(self.processed_head_ppg, self.fs, self.logger, Config.BCG_Param)
-        self.head_avg_ptt = self.processed_head_ppg.process(self.IJK, self.ecg.peak_indices_corrected)
-        return self
\ No newline at end of file
+        self.processed_head_ppg = apply_shannon_entropy(raw_data, Config.entropy_reduction).rename('Head PPG Entropy')
+        self.processed_head_ppg = PPG_Signal(self.processed_head_ppg, self.fs, self.logger, Config.BCG_Param, Config.working_fs, Config.outlier_handling)
+        self.head_avg_ptt = self.processed_head_ppg.process(self.IJK, self.bcg.r_peaks)
+        return self
+
+    @profiled
+    @cached
+    def process_beats(self) -> None:
+        from src.beat_table import build_beat_table
+        self.beats = build_beat_table(self.ecg.peak_indices_corrected, *self.IJK, self.ppg.troughs, self.processed_head_ppg.troughs, self.bp, self.fs, *self.imu_IJK[:2], {'systolic': self.systolic_p, 'diastolic': self.diastolic_p})
+        if Config.Beat_Param.PTT_Param['method']:
+            from src.beat_quality import cluster_ptts
+            for name in [column for column in self.beats.columns if column.startswith('ptt_')]:
+                self.beats.loc[~cluster_ptts(self.beats[name], **Config.Beat_Param.PTT_Param), name] = np.nan
+        self.logger.info(f'Beat table built for session {self.session} ({self.state}): {len(self.beats)} beats')
+        return self
+
+# Session data and Config of the worker processes of Recording.run and sweep, sent once per worker instead of once per task
+worker_state = {}
+
+def init_worker(recording: pd.DataFrame, config: dict, cache_dir: str = None, content_hash: str = None) -> None:
+    '''
+    Initializer of the worker processes: whatever the start method, the workers process the data of the parent with its Config
+    Input:
+        recording: pd.DataFrame: The session data (Recording.recording)
+        config: dict: The Config of the parent (config_snapshot)
+        cache_dir: str: Result_Cache directory shared with the parent (sweep)
+        content_hash: str: hash_frame of the session data, so the workers do not hash it again
+    '''
+    apply_config(config)
+    worker_state.update(
+        recording=recording, config=config,
+        cache=Result_Cache(cache_dir, max_bytes=float('inf')) if cache_dir else None,
+        content_hashes={config['dtype']: content_hash} if content_hash else {}
+    )
+
+def run_stage(inputs: dict, stage: str) -> dict:
+    '''
+    Run one stage of a recording in a worker process (Recording.run with backend='process')
+    Input:
+        inputs: dict: The attributes of the recording the stage can read (Recording.stage_inputs)
+    Output:
+        dict: The outputs of the stage (Recording.outputs)
+    '''
+    recording = Recording.__new__(Recording)
+    recording.__dict__.update(inputs, recording=worker_state['recording'])
+    getattr(recording, stage)()
+    return {name: getattr(recording, name) for name in Recording.outputs[stage]}
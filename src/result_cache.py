@@ -0,0 +1,124 @@
+import os
+import json
+import pickle
+import hashlib
+import threading
+import functools
+import numpy as np
+import pandas as pd
+from typing import Any, Callable, List
+
+from src.config import Config
+
+class Result_Cache:
+    '''
+    On-disk cache of the outputs of the Recording stages, one pickle per stage result named by its key
+    Keys are content addressed (see Recording.stage_key), so entries never need to be invalidated: a changed input or
+    parameter gives a new key. Files are written atomically, so several processes and threads can share a directory.
+    When the directory grows over max_bytes, the least recently used entries are removed.
+    '''
+    # Bump when a change in the processing code makes the stored results stale
+    version = 1
+
+    def __init__(self, directory: str, max_bytes: int = 2 * 2 ** 30) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def get(self, key: str) -> dict:
+        '''
+        Output:
+            dict: The stored outputs (attribute name -> value), None if the key is not cached
+        '''
+        try:
+            with open(self.path(key), 'rb') as f:
+                values = pickle.load(f)
+            os.utime(self.path(key))
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            # Missing, or removed by another process while reading
+            return None
+        return values
+
+    def put(self, key: str, values: dict) -> None:
+        temporary = f'{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as f:
+            pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.path(key))
+        self.evict()
+
+    def size(self) -> int:
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith('.pkl'))
+
+    def evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                os.remove(entry.path)
+
+def hash_frame(df: pd.DataFrame) -> str:
+    '''
+    Hash of the column names, dtypes and values of a DataFrame (the index is ignored)
+    '''
+    hasher = hashlib.blake2b(digest_size=16)
+    for column in df.columns:
+        values = df[column].values
+        if values.dtype == object:
+            values = values.astype(str)
+        hasher.update(f'{column}:{values.dtype}:{len(values)}'.encode())
+        hasher.update(memoryview(np.ascontiguousarray(values)).cast('B'))
+    return hasher.hexdigest()
+
+def hash_parameters(names: List[str]) -> dict:
+    '''
+    Canonical form of the given Config attributes (parameter classes such as ECG_Param become dicts of their settings)
+    '''
+    canonical = {}
+    for name in names:
+        value = getattr(Config, name)
+        if isinstance(value, type):
+            value = {key: item for key, item in vars(value).items() if not key.startswith('_')}
+        canonical[name] = value
+    return canonical
+
+def hash_key(*parts: Any) -> str:
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+def cached(method: Callable) -> Callable:
+    '''
+    Look a Recording.process_* method up in the recording's Result_Cache before running it
+    A hit sets the outputs of the stage (Recording.outputs) from the cache, a miss runs the stage and stores them.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+        stage = method.__name__
+        key = self.stage_key(stage)
+        values = self.cache.get(key)
+        if values is not None:
+            for name, value in values.items():
+                setattr(self, name, value)
+            self.logger.info(f'{stage} loaded from cache for session {self.session} ({self.state})')
+            return self
+        method(self, *args, **kwargs)
+        self.cache.put(key, {name: getattr(self, name) for name in type(self).outputs[stage]})
+        return self
+    return wrapper
@@ -0,0 +1,108 @@
+import logging
+import tempfile
+import itertools
+import functools
+import pandas as pd
+from typing import Any, Dict, List
+from concurrent.futures import ProcessPoolExecutor
+
+from src.config import Config, config_snapshot, apply_config
+from src.recording import Recording, init_worker, worker_state
+from src.batch import summarize
+from src.result_cache import hash_frame
+
+def get_parameter(path: str) -> Any:
+    '''
+    Value of a Config parameter given as a dotted path, e.g. 'ecg_filter_type' or 'BCG_Param.BPF_Param.lowcut'
+    '''
+    value = Config
+    for name in path.split('.'):
+        value = value[name] if isinstance(value, dict) else getattr(value, name)
+    return value
+
+def set_parameter(path: str, value: Any) -> None:
+    *parents, name = path.split('.')
+    target = get_parameter('.'.join(parents)) if parents else Config
+    if isinstance(target, dict):
+        target[name] = value
+    else:
+        setattr(target, name, value)
+
+def upstream_parameters(stage: str) -> set:
+    '''
+    Config attributes read by a stage or by any stage it depends on
+    '''
+    names = set(Recording.parameters[stage])
+    for dependency in Recording.dependencies[stage]:
+        names |= upstream_parameters(dependency)
+    return names
+
+def run_combination(stage: str, parameters: Dict[str, Any], session: int, fs: int) -> dict:
+    '''
+    Run one stage of the recording with the given parameters in a worker, its upstream stages are read from the shared cache
+    The parameters are set on top of the Config of the parent (see init_worker), not of the previous task.
+    '''
+    apply_config(worker_state['config'])
+    for path, value in parameters.items():
+        set_parameter(path, value)
+    logger = logging.getLogger('sweep')
+    result = dict(parameters)
+    try:
+        recording = Recording(worker_state['recording'], logger, session, fs, cache=worker_state['cache'])
+        # The session data is hashed as cast to Config.dtype, which can be one of the swept parameters
+        hashes = worker_state['content_hashes']
+        if Config.dtype not in hashes:
+            hashes[Config.dtype] = hash_frame(recording.recording)
+        recording.content_hash = hashes[Config.dtype]
+        getattr(recording, stage)()
+        if stage == 'process_beats':
+            result.update(summarize(recording))
+    except Exception as e:
+        logger.exception(f'{stage} failed for {parameters}')
+        result['error'] = repr(e)
+    return result
+
+def sweep(df: pd.DataFrame, logger: logging.Logger, session: int, grid: Dict[str, List[Any]], fs: int = 2000, target: str = 'head_bp_corr', max_workers: int = None, cache_dir: str = None) -> pd.DataFrame:
+    '''
+    Process a session for every combination of the parameter grid, sharing the stages the combinations have in common
+    The combinations form a prefix tree over the stages (Recording.parameters / Recording.dependencies): every distinct
+    ECG configuration is processed once, then every distinct BCG configuration on top of it, and so on. Each level runs
+    in a process pool and hands its outputs to the next through a Result_Cache. The workers start from the Config of the
+    caller (including settings that are not swept).
+    Input:
+        df: pd.DataFrame: The recording (as for Recording)
+        session: int: The session to process
+        grid: Dict[str, List[Any]]: Values of every swept Config parameter, keyed by dotted path (e.g. 'ECG_Param.BPF_Param.highcut')
+        target: str: Column to rank the combinations by (most negative PTT - BP correlation first)
+        max_workers: int: The number of processes (all cores by default)
+        cache_dir: str: Result_Cache directory, a temporary one is used by default
+    Output:
+        pd.DataFrame: One row per combination with its parameters, heart rate, average PTTs and PTT - BP correlations
+    '''
+    for path in grid:
+        get_parameter(path)
+    combinations = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    recording = Recording(df, logger, session, fs)
+    content_hash = hash_frame(recording.recording)
+    # Stages that other stages read from, in dependency order (the dependency lists include indirect dependencies), ties in
+    # the order of Recording.outputs so the schedule does not depend on the hash seed
+    order = list(Recording.outputs)
+    stages = sorted({dependency for dependencies in Recording.dependencies.values() for dependency in dependencies}, key=lambda stage: (len(Recording.dependencies[stage]), order.index(stage)))
+    with tempfile.TemporaryDirectory() as temporary:
+        run = functools.partial(run_combination, session=session, fs=fs)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(recording.recording, config_snapshot(), cache_dir or temporary, content_hash)) as executor:
+            for stage in stages:
+                relevant = upstream_parameters(stage)
+                if not relevant:
+                    # Reads no Config (e.g. process_bp): nothing to compute ahead of the leaves
+                    continue
+                prefixes = {tuple((path, value) for path, value in combination.items() if path.split('.')[0] in relevant): None for combination in combinations}
+                if len(prefixes) == len(combinations):
+                    # Nothing to share for this stage, the leaves run it (the stages form a DAG, later ones can still share)
+                    continue
+                logger.info(f'Sweep: {stage} for {len(prefixes)} distinct configurations')
+                list(executor.map(run, itertools.repeat(stage), map(dict, prefixes)))
+            logger.info(f'Sweep: {len(combinations)} combinations')
+            results = list(executor.map(run, itertools.repeat('process_beats'), combinations))
+    results = pd.DataFrame(results)
+    return results.sort_values(target, na_position='last').reset_index(drop=True)
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+from typing import Tuple
+
+def gaussian(t: np.ndarray, center: float, width: float) -> np.ndarray:
+    return np.exp(-0.5 * ((t - center) / width) ** 2)
+
+def add_template(signal: np.ndarray, template: np.ndarray, positions: np.ndarray, offset: int) -> None:
+    '''
+    Add the template to the signal at every position (template index offset sits on the position), in place
+    '''
+    n, length = len(signal), len(template)
+    for position in positions:
+        start = position - offset
+        lo, hi = max(start, 0), min(start + length, n)
+        if lo < hi:
+            signal[lo:hi] += template[lo - start:hi - start]
+
+def generate_recording(duration: float, fs: int = 2000, session: int = 10, heart_rate: float = 70, ptt: float = 0.3, head_ptt: float = 0.32,
+                       ptt_bp_slope: float = -0.002, noise: float = 0.02, seed: int = 0) -> Tuple[pd.DataFrame, dict]:
+    '''
+    Generate a synthetic recording with known fiducial points, laid out like the dataset csv files
+    ECG: QRS (R at the beat), T wave, respiration baseline and noise
+    BCG (force plate): I, J, K waves at 180, 230 and 280 ms after R, also seen by the accelerometer on top of gravity
+    Finger / Head PPG: pulse whose maximum upslope (the trough found by PPG_Signal) is ptt / head_ptt after R
+    BP: slow blood pressure changes; the PTT of each beat follows it with ptt_bp_slope (s / mmHg)
+    Input:
+        duration: float: The duration (in seconds)
+        fs: int: The sampling frequency
+        session: int: The session number written in the session column
+        heart_rate: float: The mean heart rate (bpm)
+        ptt: float: The mean R -> finger trough delay (in seconds)
+        head_ptt: float: The mean R -> head trough delay (in seconds)
+        ptt_bp_slope: float: The change of the PTT per mmHg
+        noise: float: The standard deviation of the additive noise
+        seed: int: The random seed
+    Output:
+        Tuple[pd.DataFrame, dict]: The recording and the ground truth sample indices (R, I, J, K, trough, head_trough) and PTTs (in ms)
+    '''
+    rng = np.random.default_rng(seed)
+    n = int(duration * fs)
+    t = np.arange(n) / fs
+
+    # Beat times with heart rate variability
+    rr = 60 / heart_rate
+    intervals = rr + 0.03 * rr * rng.standard_normal(int(duration / rr) + 2)
+    beats = 0.5 + np.cumsum(intervals) - intervals[0]
+    beats = beats[beats < duration - 1.0]
+    r_peaks = np.round(beats * fs).astype(int)
+
+    # Blood pressure and the PTT it drives
+    bp = 90 + 10 * np.sin(2 * np.pi * t / 60) + np.cumsum(rng.standard_normal(n)) * 0.01
+    bp_at_beat = bp[r_peaks]
+    finger_ptts = ptt + ptt_bp_slope * (bp_at_beat - bp_at_beat.mean())
+    head_ptts = head_ptt + ptt_bp_slope * (bp_at_beat - bp_at_beat.mean())
+
+    # ECG
+    tt = np.arange(-int(0.4 * fs), int(0.4 * fs)) / fs
+    qrs = gaussian(tt, 0, 0.008) - 0.15 * gaussian(tt, -0.025, 0.008) - 0.2 * gaussian(tt, 0.025, 0.008) + 0.25 * gaussian(tt, 0.25, 0.04)
+    ecg = 0.5 * np.sin(2 * np.pi * 0.25 * t) + 1.5 * np.sin(2 * np.pi * 0.03 * t) + noise * rng.standard_normal(n)
+    add_template(ecg, qrs, r_peaks, int(0.4 * fs))
+
+    # Force plate BCG
+    offsets = {'I': 0.18, 'J': 0.23, 'K': 0.28}
+    ijk = -0.6 * gaussian(tt, offsets['I'], 0.012) + gaussian(tt, offsets['J'], 0.012) - 0.7 * gaussian(tt, offsets['K'], 0.012)
+    bcg = 0.3 * np.sin(2 * np.pi * 0.25 * t) + noise * rng.standard_normal(n)
+    add_template(bcg, ijk, r_peaks, int(0.4 * fs))
+
+    # PPG pulses, the maximum upslope of the template is at index offset
+    tp = np.arange(-int(0.2 * fs), int(0.8 * fs)) / fs
+    pulse = 0.5 * (1 + np.tanh(tp / 0.03)) * np.exp(-np.clip(tp, 0, None) / 0.6)
+    pulse_offset = int(np.argmax(np.diff(pulse)))
+    finger_troughs = r_peaks + np.round(finger_ptts * fs).astype(int)
+    head_troughs = r_peaks + np.round(head_ptts * fs).astype(int)
+    ppg = 0.2 * np.sin(2 * np.pi * 0.25 * t) + noise * rng.standard_normal(n)
+    add_template(ppg, pulse, finger_troughs, pulse_offset)
+    head_ppg = []
+    for gain in [0.25, 0.2, 0.15]:
+        channel = 0.05 + 0.02 * np.sin(2 * np.pi * 0.25 * t) + 0.5 * noise * rng.standard_normal(n)
+        add_template(channel, gain * pulse, head_troughs, pulse_offset)
+        head_ppg.append(channel)
+
+    # Accelerometer (in g), gravity and the BCG along Z
+    imu = [1 + 0.5 * bcg + noise * rng.standard_normal(n), noise * rng.standard_normal(n), noise * rng.standard_normal(n)]
+
+    df = pd.DataFrame({
+        'session': np.full(n, session),
+        'chest sternum ECG': ecg,
+        'force plate BCG': bcg,
+        'IMU Z': imu[0],
+        'IMU Y': imu[1],
+        'IMU X': imu[2],
+        'finapres BP': bp,
+        'finger PPG': ppg,
+        'finapres systolic': bp + 25,
+        'finapres diastolic': bp - 15,
+        'head forehead PPG IR': head_ppg[0],
+        'head forehead PPG R': head_ppg[1],
+        'head forehead PPG G': head_ppg[2]
+    })
+    truth = {
+        'R': r_peaks,
+        'I': r_peaks + int(offsets['I'] * fs),
+        'J': r_peaks + int(offsets['J'] * fs),
+        'K': r_peaks + int(offsets['K'] * fs),
+        'trough': finger_troughs,
+        'head_trough': head_troughs,
+        'ptt': finger_ptts * 1000,
+        'head_ptt': head_ptts * 1000
+    }
+    return df, truth
@@ -1,7 +1,23 @@
-from scipy.signal import butter, sosfiltfilt, savgol_filter
+from scipy.signal import butter, sosfiltfilt, savgol_filter, find_peaks, lfilter, resample_poly, convolve, get_window
+from numpy.lib.stride_tricks import sliding_window_view
+from functools import lru_cache
 import pandas as pd
 import numpy as np
-from typing import List, Union, Any
+from typing import List, Union, Any, Tuple
+
+def as_float_array(signal: Union[pd.Series, pd.DataFrame, np.ndarray], dtype: str = None) -> np.ndarray:
+    '''
+    Get the signal as a floating point array, copying only when it is not floating point (float64 then) or not of the given dtype
+    Input:
+        signal: Union[pd.Series, pd.DataFrame, np.ndarray]: The input signal
+        dtype: str: The dtype to convert to (keep the floating point dtype of the signal by default)
+    Output:
+        np.ndarray: The signal values
+    '''
+    x = np.asarray(signal)
+    if dtype is not None:
+        return x.astype(dtype, copy=False)
+    return x if np.issubdtype(x.dtype, np.floating) else x.astype(np.float64)
 
 def remove_outliers(signal: pd.Series):
     '''
@@ -26,21 +42,73 @@ def round_within(x: float, lower_bound: int = 0, upper_bound: int = None) -> int
     '''
     return 0 if x < lower_bound else int(x) if not upper_bound else upper_bound if x > upper_bound else int(x)
 
-def butter_bandpass(lowcut: int, highcut: int, order: int, fs: int):
+def clip_outliers(signal: pd.Series, mode: str = 'clip', lower: float = 0.01, upper: float = 0.98, bounds: Tuple[float, float] = None, max_z: float = None, inplace: bool = False) -> pd.Series:
     '''
-    Create a bandpass filter (Butterworth filter)
+    Handle the samples outside the lower / upper quantiles of the signal without removing them, so the signal keeps its timebase
+    Both quantiles come from one partition of the values. For chunked or streamed input, give the bounds instead
+    (e.g. from a Quantile_Sketch of the signal so far, see src/quantiles.py and ECG_Stream). With max_z, the bounds are
+    the median -/+ max_z scaled median absolute deviations, which leave the physiological extremes of a signal alone.
     Input:
-        lowcut: int: The lower cutoff frequency
-        highcut: int: The higher cutoff frequency
-        order: int: The filter order
+        signal: pd.Series: The input signal
+        mode: str: 'clip' (set to the nearest bound), 'interpolate' (linear between the neighbouring inliers), 'drop' (remove_outliers, shortens the signal) or None (keep the signal as it is)
+        lower, upper: float: The quantiles
+        bounds: Tuple[float, float]: The lower and upper bound to use instead of the quantiles of the signal
+        max_z: float: Robust z-score of the bounds, instead of the quantiles
+        inplace: bool: Overwrite the values of the signal instead of copying them
     Output:
-        tuple: The filter coefficients
+        pd.Series: The signal with its outliers handled (same length and index)
+    '''
+    assert mode in [None, 'clip', 'interpolate', 'drop'], 'Mode must be None, "clip", "interpolate" or "drop"'
+    if mode is None:
+        return signal
+    if mode == 'drop':
+        return remove_outliers(signal)
+    x = as_float_array(signal)
+    if bounds is not None:
+        low, high = bounds
+    elif max_z is not None:
+        median = np.nanmedian(x)
+        spread = max_z * 1.4826 * np.nanmedian(np.abs(x - median))
+        low, high = median - spread, median + spread
+    else:
+        low, high = np.quantile(x, [lower, upper]) if not np.isnan(x).any() else np.nanquantile(x, [lower, upper])
+    y = x if inplace else np.empty_like(x)
+    if mode == 'clip':
+        np.clip(x, low, high, out=y)
+    else:
+        inliers = (x >= low) & (x <= high)
+        if not inplace:
+            y[...] = x
+        if inliers.any() and not inliers.all():
+            positions = np.arange(len(x))
+            y[~inliers] = np.interp(positions[~inliers], positions[inliers], x[inliers])
+    if inplace and isinstance(signal, pd.Series) and np.shares_memory(y, signal.values):
+        return signal
+    return pd.Series(y, index=getattr(signal, 'index', None), name=getattr(signal, 'name', None))
+
+@lru_cache(maxsize=None)
+def bandpass_design(lowcut: int, highcut: int, order: int, fs: int) -> np.ndarray:
+    '''
+    Butterworth bandpass sections, designed once per (lowcut, highcut, order, fs) and shared read-only by every caller
     '''
     nyq = 0.5 * fs
     normalized_cutoffs = [lowcut / nyq, highcut / nyq]
     sos = butter(order, normalized_cutoffs, btype='bandpass', output='sos')
+    sos.setflags(write=False)
     return sos
 
+def butter_bandpass(lowcut: int, highcut: int, order: int, fs: int):
+    '''
+    Create a bandpass filter (Butterworth filter) from the cached design
+    Input:
+        lowcut: int: The lower cutoff frequency
+        highcut: int: The higher cutoff frequency
+        order: int: The filter order
+    Output:
+        tuple: The filter coefficients (a copy of the cached ones, scipy's sosfilt needs a writable array)
+    '''
+    return bandpass_design(lowcut, highcut, order, fs).copy()
+
 def apply_bp_filter(lowcut: int, highcut: int, order: int, fs: int, signal: pd.Series) -> pd.Series:
     '''
     Apply a bandpass filter to the signal (Butterworth filter)
@@ -52,11 +120,12 @@ def apply_bp_filter(lowcut: int, highcut: int, order: int, fs: int, signal: pd.S
     Output:
         pd.Series: The filtered signal
     '''
-    sos = butter_bandpass(lowcut, highcut, order, fs)
-    y = sosfiltfilt(sos, signal)
+    x = as_float_array(signal)
+    sos = butter_bandpass(lowcut, highcut, order, fs).astype(x.dtype, copy=False)
+    y = sosfiltfilt(sos, x)
     return pd.Series(y)
 
-def apply_derivative_filter(signal: pd.Series, p: int, w: int, m: int) -> pd.Series:
+def apply_derivative_filter(signal: pd.Series, p: int, w: int, m: int, delta: float = 1.0) -> pd.Series:
     '''
     Apply a derivative filter to the signal (Savitzky-Golay filter)
     Input:
@@ -64,24 +133,143 @@ def apply_derivative_filter(signal: pd.Series, p: int, w: int, m: int) -> pd.Ser
         p: int: The polynomial order
         w: int: The window size
         m: int: The derivative order
+        delta: float: The sample spacing (decimation factor of a decimated signal, so the derivative keeps its full-rate scale)
     Output:
         pd.Series: The filtered signal
     '''
-    y = savgol_filter(signal, polyorder=p, window_length=w, deriv=m)
+    y = savgol_filter(signal, polyorder=p, window_length=w, deriv=m, delta=delta)
     return pd.Series(y)
 
-def apply_rolling(signal: pd.Series, fs: int, window_ms: int, win_type: str = None, rolling_type: str = ['mean' or 'median']) -> pd.Series:
+def decimation_factor(fs: int, working_fs: int = None) -> int:
+    '''
+    Integer decimation factor that brings fs down to (at least) working_fs, 1 if no working rate is set
+    '''
+    return max(int(fs // working_fs), 1) if working_fs else 1
+
+def decimate_signal(signal: Union[pd.Series, np.ndarray], q: int) -> np.ndarray:
+    '''
+    Decimate the signal by q with a zero-phase anti-aliasing FIR filter (polyphase)
+    Input:
+        signal: Union[pd.Series, np.ndarray]: The input signal
+        q: int: The decimation factor
+    Output:
+        np.ndarray: The decimated signal
+    '''
+    x = as_float_array(signal)
+    return x if q == 1 else resample_poly(x, 1, q)
+
+def scale_filter_params(SavGol_Param: dict, EMA_Param: dict, q: int) -> Tuple[dict, dict]:
+    '''
+    Adapt the sample-based Savitzky-Golay window and EMA span to a signal decimated by q, so they cover the same time span
+    Input:
+        SavGol_Param: dict: The full-rate Savitzky-Golay parameters
+        EMA_Param: dict: The full-rate EMA parameters
+        q: int: The decimation factor
+    Output:
+        Tuple[dict, dict]: The Savitzky-Golay (with delta) and EMA parameters for the decimated signal
+    '''
+    if q == 1:
+        return SavGol_Param, EMA_Param
+    p = SavGol_Param['p']
+    w = int(round(SavGol_Param['w'] / q)) | 1
+    w = max(w, p + 1 if p % 2 == 0 else p + 2)
+    span = max((EMA_Param['span'] + 1) / q - 1, 1)
+    return {**SavGol_Param, 'w': w, 'delta': q}, {**EMA_Param, 'span': span}
+
+def refine_indices(signal: Union[pd.Series, np.ndarray], indices: List[int], q: int) -> np.ndarray:
+    '''
+    Map extrema found on a signal decimated by q back to full-rate indices with parabolic interpolation of the neighbours
+    Input:
+        signal: Union[pd.Series, np.ndarray]: The decimated signal the extrema were found on
+        indices: List[int]: The extremum indices on the decimated signal
+        q: int: The decimation factor
+    Output:
+        np.ndarray: The full-rate indices
+    '''
+    x = as_float_array(signal)
+    indices = np.asarray(indices, dtype=np.int64)
+    if q == 1 or len(indices) == 0:
+        return indices * q
+    inner = np.clip(indices, 1, len(x) - 2)
+    left, center, right = x[inner - 1], x[inner], x[inner + 1]
+    curvature = left - 2 * center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(curvature != 0, 0.5 * (left - right) / curvature, 0.0)
+    offset = np.where(inner == indices, np.clip(offset, -0.5, 0.5), 0.0)
+    return np.round((indices + offset) * q).astype(np.int64)
+
+@lru_cache(maxsize=None)
+def rolling_kernel(window_size: int, win_type: str = None) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Weights of a rolling window (the scipy window pandas uses for win_type, flat without one), built once per window
+    Output:
+        Tuple[np.ndarray, np.ndarray]: The weights and, for every number of samples seen so far (1 .. window_size), the sum of the weights covering them
+    '''
+    kernel = np.ones(window_size) if win_type is None else get_window(win_type, window_size, False)
+    kernel.setflags(write=False)
+    norms = np.cumsum(kernel[::-1])
+    norms.setflags(write=False)
+    return kernel, norms
+
+def rolling_weighted_mean(signal: np.ndarray, window_size: int, win_type: str = None) -> np.ndarray:
+    '''
+    Trailing (weighted) moving average with min_periods=1, same as pd.Series.rolling(window_size, min_periods=1, win_type=win_type).mean()
+    A convolution with the cached kernel (direct or FFT, whichever scipy estimates faster), normalised by the weights of the samples present.
+    '''
+    x = as_float_array(signal)
+    kernel, norms = rolling_kernel(window_size, win_type)
+    valid = ~np.isnan(x)
+    if valid.all():
+        numerator = convolve(x, kernel.astype(x.dtype), method='auto')[:len(x)]
+        denominator = np.concatenate([norms[:min(window_size, len(x))], np.full(max(len(x) - window_size, 0), norms[-1])]).astype(x.dtype)
+    else:
+        # Missing samples do not count, as in pandas
+        numerator = convolve(np.where(valid, x, 0), kernel.astype(x.dtype), method='auto')[:len(x)]
+        denominator = convolve(valid.astype(x.dtype), kernel.astype(x.dtype), method='auto')[:len(x)]
+        denominator[np.convolve(valid, np.ones(window_size))[:len(x)] < 0.5] = np.nan
+    return numerator / denominator
+
+def rolling_median(signal: np.ndarray, window_size: int, block: int = 65536) -> np.ndarray:
+    '''
+    Trailing moving median with min_periods=1, same as pd.Series.rolling(window_size, min_periods=1).median()
+    Short windows (up to 16 samples, e.g. 5 ms at 2 kHz) use a partial sort of the sliding windows in blocks of rows;
+    longer windows, or signals with missing samples, use the O(n log w) skiplist of pandas.
+    '''
+    x = as_float_array(signal)
+    if window_size == 1:
+        return x.copy()
+    if window_size > 16 or len(x) < window_size or np.isnan(x).any():
+        return pd.Series(x).rolling(window_size, min_periods=1).median().to_numpy()
+    y = np.empty_like(x)
+    # The first window_size - 1 outputs only see the samples so far
+    head = np.concatenate([np.full(window_size - 1, np.nan, dtype=x.dtype), x[:window_size - 1]])
+    y[:window_size - 1] = np.nanmedian(sliding_window_view(head, window_size), axis=1)
+    windows = sliding_window_view(x, window_size)
+    middle = [(window_size - 1) // 2, window_size // 2]
+    for start in range(0, len(windows), block):
+        ordered = np.partition(windows[start:start + block], middle, axis=1)
+        y[window_size - 1 + start:window_size - 1 + start + len(ordered)] = (ordered[:, middle[0]] + ordered[:, middle[1]]) / 2
+    return y
+
+def apply_rolling(signal: pd.Series, fs: int, window_ms: int, win_type: str = None, rolling_type: str = ['mean' or 'median'], backend: str = 'kernel') -> pd.Series:
     '''
     Apply a rolling filter to the signal
     Input:
         signal: pd.Series: The input signal
         window_size: int: The window size
+        backend: str: 'kernel' (rolling_weighted_mean / rolling_median) or 'pandas' (Series.rolling), both give the same output
     Output:
         pd.Series: The filtered signal
     '''
     window_size = int(window_ms * fs * 1e-3)
-    obs = signal.rolling(min_periods=1, window=window_size, win_type = win_type if win_type else None)
-    return obs.mean() if rolling_type == 'mean' else obs.median()
+    if backend == 'pandas':
+        obs = signal.rolling(min_periods=1, window=window_size, win_type = win_type if win_type else None)
+        y = obs.mean() if rolling_type == 'mean' else obs.median()
+        return y.astype(signal.dtype, copy=False)
+    assert backend == 'kernel', 'Backend must be either "kernel" or "pandas"'
+    assert rolling_type == 'mean' or not win_type, 'A weighted window only supports the mean'
+    y = rolling_weighted_mean(signal, window_size, win_type if win_type else None) if rolling_type == 'mean' else rolling_median(signal, window_size)
+    return pd.Series(y, index=signal.index, name=signal.name).astype(signal.dtype, copy=False)
 
 def apply_rolling_ema(signal: pd.Series, span: int) -> pd.Series:
     '''
@@ -92,7 +280,24 @@ def apply_rolling_ema(signal: pd.Series, span: int) -> pd.Series:
     Output:
         pd.Series: The filtered signal
     '''
-    return signal.ewm(span=span, adjust=False).mean()
+    return signal.ewm(span=span, adjust=False).mean().astype(signal.dtype, copy=False)
+
+def ema_filter(signal: np.ndarray, span: int, axis: int = 0) -> np.ndarray:
+    '''
+    Apply an exponential moving average along an axis, same as pd.Series.ewm(span=span, adjust=False).mean()
+    Input:
+        signal: np.ndarray: The input signal
+        span: int: The span size
+        axis: int: The time axis
+    Output:
+        np.ndarray: The filtered signal
+    '''
+    signal = as_float_array(signal)
+    alpha = 2 / (span + 1)
+    b, a = np.array([alpha], dtype=signal.dtype), np.array([1, alpha - 1], dtype=signal.dtype)
+    zi = (1 - alpha) * np.take(signal, [0], axis=axis)
+    y, _ = lfilter(b, a, signal, axis=axis, zi=zi.astype(signal.dtype, copy=False))
+    return y
 
 def calculate_peak_indices(signal: pd.Series, fs: int) -> List[int]:
     '''
@@ -126,6 +331,89 @@ def calculate_peak_indices(signal: pd.Series, fs: int) -> List[int]:
             
     return peak_vals
 
+def calculate_peak_indices_vectorized(signal: Union[pd.Series, np.ndarray], fs: int) -> List[int]:
+    '''
+    Calculate the peak indices of the signal (NumPy implementation of calculate_peak_indices)
+    Candidate samples above the threshold are located in bulk, so windows without a candidate are
+    skipped at once instead of being scanned one by one. Returns the same peaks as calculate_peak_indices.
+    Input:
+        signal: Union[pd.Series, np.ndarray]: The input signal
+        fs: int: The sampling frequency
+    Output:
+        List[int]: The peak indices
+    '''
+    x = as_float_array(signal)
+    distance = int(0.2 * fs) # value based on the refractory period of the human cardiac cells, 200 ms
+    delta = int(distance / 2)
+    min_height = x.mean(dtype=np.float64) + 1.5 * x.std(ddof=1, dtype=np.float64)
+    candidates = np.flatnonzero(x >= min_height)
+    peak_vals = []
+    start = int(0.01 * fs) # 10ms offset
+    end = len(x)
+    while start < end:
+        k = np.searchsorted(candidates, start)
+        if k == len(candidates):
+            break
+        # Jump straight to the window holding the next candidate, every window before it is below threshold
+        start += (candidates[k] - start) // distance * distance
+        if start + distance < end:
+            peak = start + int(np.argmax(x[start:start + distance]))
+            peak += int(np.argmax(x[peak:min(peak + delta, end)]))
+            peak_vals.append(peak)
+            start = peak + distance
+        else:
+            peak = start + int(np.argmax(x[start:]))
+            peak_vals.append(peak) if x[peak] > min_height else None
+            break
+
+    return peak_vals
+
+def calculate_peak_indices_scipy(signal: Union[pd.Series, np.ndarray], fs: int) -> List[int]:
+    '''
+    Calculate the peak indices of the signal with scipy.signal.find_peaks
+    Input:
+        signal: Union[pd.Series, np.ndarray]: The input signal
+        fs: int: The sampling frequency
+    Output:
+        List[int]: The peak indices
+    '''
+    x = as_float_array(signal)
+    peaks, _ = find_peaks(x, distance=int(0.2 * fs), height=x.mean(dtype=np.float64) + 0.5 * x.std(ddof=1, dtype=np.float64))
+    return peaks.tolist()
+
+def calculate_windowed_extrema(signal: Union[pd.Series, np.ndarray], anchors: List[int], fs: int, lbound: float, ubound: float, mode: str = 'max') -> np.ndarray:
+    '''
+    Calculate the arg-extremum of the signal in a window around every anchor at once
+    Window edges are clipped to the signal like round_within does. A window left empty at the end of the
+    signal falls back to the last sample instead of raising.
+    Input:
+        signal: Union[pd.Series, np.ndarray]: The input signal
+        anchors: List[int]: The anchor indices
+        fs: int: The sampling frequency
+        lbound: float: The window start relative to the anchor (in seconds)
+        ubound: float: The window end relative to the anchor (in seconds)
+        mode: str: 'max' or 'min'
+    Output:
+        np.ndarray: The index of the extremum in each window
+    '''
+    assert mode in ['max', 'min'], 'Mode must be either "max" or "min"'
+    x = as_float_array(signal)
+    anchors = np.asarray(anchors, dtype=np.int64)
+    end = len(x)
+    if len(anchors) == 0:
+        return np.empty(0, dtype=np.int64)
+    lower = np.clip(np.trunc(anchors + lbound * fs), 0, end).astype(np.int64)
+    upper = np.clip(np.trunc(anchors + ubound * fs), 0, end).astype(np.int64)
+    lower = np.minimum(lower, end - 1)
+    upper = np.maximum(upper, lower + 1)
+    offsets = np.arange((upper - lower).max())
+    indices = lower[:, None] + offsets[None, :]
+    values = x[np.minimum(indices, end - 1)]
+    fill = -np.inf if mode == 'max' else np.inf
+    values[(indices >= upper[:, None]) | np.isnan(values)] = fill
+    extrema = values.argmax(axis=1) if mode == 'max' else values.argmin(axis=1)
+    return lower + extrema
+
 def calculate_peak_indices_conditioned(signal: pd.Series, fs: int, r_peaks: List[int], lbound: float = 0.1, ubound: float = 0.3) -> List[int]:
     '''
     Calculate the peak indices of the signal
@@ -136,14 +424,7 @@ def calculate_peak_indices_conditioned(signal: pd.Series, fs: int, r_peaks: List
     Output:
         List[int]: The peak indices
     '''
-    peak_vals = []
-    end = len(signal)
-    
-    for peak in r_peaks:
-        time_margin = slice(round_within(peak + lbound * fs, upper_bound=end), round_within(peak + ubound * fs, upper_bound=end))
-        local_max = signal[time_margin].idxmax()
-        peak_vals.append(local_max)
-    return peak_vals
+    return calculate_windowed_extrema(signal, r_peaks, fs, lbound, ubound, mode='max').tolist()
 
 def corrected_peaks(signal: pd.Series, peaks: List[int], fs: int) -> List[int]:
     '''
@@ -154,16 +435,7 @@ def corrected_peaks(signal: pd.Series, peaks: List[int], fs: int) -> List[int]:
     Output:
         List[int]: The corrected peak indices
     '''
-    end = len(signal)
-    corrected_peaks = []
-    for peak in peaks:
-        window = slice(round_within(peak - 0.07 * fs, upper_bound=end), round_within(peak + 0.07 * fs, upper_bound=end))
-        local_max = signal[window].idxmax()
-        if local_max != peak:
-            corrected_peaks.append(local_max)
-        else:
-            corrected_peaks.append(peak)
-    return corrected_peaks
+    return calculate_windowed_extrema(signal, peaks, fs, -0.07, 0.07, mode='max').tolist()
 
 def calculate_valleys(signal: pd.Series, peaks: List[int], fs: int) -> List[int]:
     '''
@@ -174,32 +446,71 @@ def calculate_valleys(signal: pd.Series, peaks: List[int], fs: int) -> List[int]
     Output:
         List[int]: The valley indices
     '''
-    end = len(signal)
-    bwd_valleys = []
-    fwd_valleys = []
-    for peak in peaks:
-        bwd_window = slice(round_within(peak - 0.05 * fs, upper_bound=end), peak)
-        fwd_window = slice(peak, round_within(peak + 0.05 * fs, upper_bound=end))
-        bwd_valleys.append(signal[bwd_window].idxmin())
-        fwd_valleys.append(signal[fwd_window].idxmin())
+    bwd_valleys = calculate_windowed_extrema(signal, peaks, fs, -0.05, 0, mode='min').tolist()
+    fwd_valleys = calculate_windowed_extrema(signal, peaks, fs, 0, 0.05, mode='min').tolist()
     return bwd_valleys, fwd_valleys
 
+def match_events(anchors: Union[List[int], np.ndarray], events: Union[List[int], np.ndarray], fs: int, lbound: float, ubound: float) -> np.ndarray:
+    '''
+    Match every anchor to the first event in [anchor + lbound, anchor + ubound] (binary search on the sorted events)
+    Input:
+        anchors: Union[List[int], np.ndarray]: The anchor indices (-1 for a missing anchor)
+        events: Union[List[int], np.ndarray]: The event indices
+        fs: int: The sampling frequency
+        lbound: float: The window start relative to the anchor (in seconds)
+        ubound: float: The window end relative to the anchor (in seconds)
+    Output:
+        np.ndarray: The matched event of every anchor, -1 where no event falls in the window
+    '''
+    anchors = np.asarray(anchors, dtype=np.int64)
+    events = np.sort(np.asarray(events, dtype=np.int64))
+    if len(events) == 0:
+        return np.full(len(anchors), -1, dtype=np.int64)
+    positions = np.searchsorted(events, anchors + lbound * fs, side='left')
+    candidates = events[np.minimum(positions, len(events) - 1)]
+    valid = (anchors >= 0) & (positions < len(events)) & (candidates <= anchors + ubound * fs)
+    return np.where(valid, candidates, -1)
+
+def calculate_shannon_entropy(signal: Union[pd.Series, pd.DataFrame, np.ndarray], reduction: str = 'sum') -> np.ndarray:
+    '''
+    Calculate the Shannon entropy term -|x| * log|x| for every sample (0 where x is 0)
+    Input:
+        signal: Union[pd.Series, pd.DataFrame, np.ndarray]: The input signal, (n_samples,) or (n_samples, n_channels)
+        reduction: str: How to combine the channels of a 2-D input ('sum', 'mean' or 'max')
+    Output:
+        np.ndarray: The Shannon entropy of every sample
+    '''
+    reductions = {'sum': np.sum, 'mean': np.mean, 'max': np.max}
+    assert reduction in reductions, f'Reduction must be one of {list(reductions)}'
+    x = np.abs(as_float_array(signal))
+    y = np.zeros_like(x)
+    np.log(x, out=y, where=x > 0)
+    y *= -x
+    if y.ndim == 2:
+        y = reductions[reduction](y, axis=1)
+    return y
+
+def apply_shannon_entropy(signal: Union[pd.Series, pd.DataFrame, np.ndarray], reduction: str = 'sum') -> pd.Series:
+    '''
+    Apply the Shannon entropy to the signal
+    Input:
+        signal: Union[pd.Series, pd.DataFrame, np.ndarray]: The input signal, (n_samples,) or (n_samples, n_channels)
+        reduction: str: How to combine the channels of a 2-D input ('sum', 'mean' or 'max')
+    Output:
+        pd.Series: The Shannon entropy of the signal
+    '''
+    name = signal.name if isinstance(signal, pd.Series) else None
+    return pd.Series(calculate_shannon_entropy(signal, reduction), name=name)
+
 def shannon_entropy(val: Union[List[float],float]) -> float:
     '''
     Calculate the Shannon entropy for the given data
     Input:
-        list_values: list: The input data
+        val: Union[List[float], float]: The input data
     Output:
         float: The Shannon entropy of the input data
     '''
-    # Initialize the variables
-    shannon_entropy = 0
-    if isinstance(val, list):
-        for i in val:
-            shannon_entropy = abs(i) * np.log(abs(i), where=i>0)
-    else:
-        shannon_entropy = abs(val) * np.log(abs(val), where=val>0)
-    return -1 * shannon_entropy
+    return float(np.sum(calculate_shannon_entropy(val)))
 
 def fit_to_index(indices: List[int], signal: pd.Series) -> pd.Series:
     '''
@@ -210,9 +521,8 @@ def fit_to_index(indices: List[int], signal: pd.Series) -> pd.Series:
     Output:
         List[int]: The fitted indices
     '''
-    y = [False] * len(signal)
-    for i in indices:
-        y[i] = True
+    y = np.zeros(len(signal), dtype=bool)
+    y[np.asarray(indices, dtype=np.int64)] = True
     return pd.Series(y)
 
 def apply_threshold(signal: pd.Series, threshold: Union[List[float] , float]) -> pd.Series:
@@ -251,4 +561,30 @@ def min_max_scale(signal: pd.Series, threshold: Union[List[float], float] = None
             y = (y + threshold) / (2 * threshold)
     else:
         y = (y - y.min()) / (y.max() - y.min())
-    return y
\ No newline at end of file
+    return y
+
+def match_peaks(reference: List[int], peaks: List[int], tolerance: int) -> dict:
+    '''
+    Match the peaks to the reference peaks within a tolerance
+    Input:
+        reference: List[int]: The reference peak indices
+        peaks: List[int]: The peak indices to evaluate
+        tolerance: int: The maximum distance (in samples) of a match
+    Output:
+        dict: Sensitivity, positive predictive value and mean / max absolute offset of the matched peaks
+    '''
+    reference = np.sort(np.asarray(reference, dtype=np.int64))
+    peaks = np.sort(np.asarray(peaks, dtype=np.int64))
+    if len(reference) == 0 or len(peaks) == 0:
+        return {'sensitivity': 0.0, 'ppv': 0.0, 'mean_offset': np.nan, 'max_offset': np.nan}
+    right = np.clip(np.searchsorted(reference, peaks), 1, len(reference) - 1)
+    left = right - 1
+    nearest = np.where(np.abs(peaks - reference[left]) <= np.abs(peaks - reference[right]), left, right)
+    offsets = np.abs(peaks - reference[nearest])
+    matched = offsets <= tolerance
+    return {
+        'sensitivity': len(np.unique(nearest[matched])) / len(reference),
+        'ppv': matched.mean(),
+        'mean_offset': offsets[matched].mean() if matched.any() else np.nan,
+        'max_offset': offsets[matched].max() if matched.any() else np.nan
+    }
@@ -0,0 +1,35 @@
+import logging
+import numpy as np
+
+from src.config import Config
+from src.recording import Recording
+from src.synthetic import generate_recording
+
+FS = 2000
+
+def fiducials(recording: Recording) -> dict:
+    return {
+        'R': recording.ecg.peak_indices_corrected,
+        'I': recording.IJK[0],
+        'J': recording.IJK[1],
+        'K': recording.IJK[2],
+        'imu_J': recording.imu_IJK[1],
+        'trough': recording.ppg.troughs,
+        'head_trough': recording.processed_head_ppg.troughs
+    }
+
+def test_float32_matches_float64():
+    # Config.dtype = 'float32' keeps the signals and filter chains in float32, the fiducials must stay at the same samples
+    df, _ = generate_recording(120, fs=FS, seed=2)
+    logger = logging.getLogger('test')
+    reference = fiducials(Recording(df, logger, 10, fs=FS))
+    previous = Config.dtype
+    try:
+        Config.dtype = 'float32'
+        recording = Recording(df, logger, 10, fs=FS)
+        assert recording.recording['chest sternum ECG'].dtype == np.float32
+        result = fiducials(recording)
+    finally:
+        Config.dtype = previous
+    for name, indices in reference.items():
+        assert np.array_equal(indices, result[name]), name
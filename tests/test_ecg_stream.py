@@ -0,0 +1,34 @@
+import logging
+import numpy as np
+import pytest
+
+from src.config import Config
+from src.ecg_signal import ECG_Signal, ECG_Stream
+from src.synthetic import generate_recording
+from src.utils import match_peaks
+
+FS = 2000
+# Stream and batch R-peaks are matched within 5 ms; the stream misses at most the beats of its warmup
+TOLERANCE = int(0.005 * FS)
+# Minimum sensitivity / PPV per outlier mode: clipping the input of the causal filters lets a few T-waves through
+LIMITS = {None: (0.98, 0.99), 'clip': (0.95, 0.95), 'interpolate': (0.95, 0.95)}
+
+@pytest.mark.parametrize('outliers', [None, 'clip', 'interpolate'])
+@pytest.mark.parametrize('seed', [1, 5])
+def test_stream_matches_batch(outliers: str, seed: int):
+    df, _ = generate_recording(120, fs=FS, seed=seed)
+    ecg = df['chest sternum ECG']
+    logger = logging.getLogger('test')
+    batch = ECG_Signal(ecg, FS, logger, Config.ECG_Param, outliers=Config.outlier_handling)
+    batch.apply_pan_tompkins(Config.ecg_filter_type, Config.ecg_peak_detector)
+
+    # Uneven chunks, from a single sample up to 1.5 s
+    splits = np.cumsum(np.random.default_rng(0).integers(1, 3000, size=len(ecg) // 500))
+    stream = ECG_Stream(FS, logger, Config.ECG_Param, outliers=outliers)
+    for chunk in np.split(ecg.to_numpy(), splits[splits < len(ecg)]):
+        stream.process_chunk(chunk)
+    stream.flush()
+
+    matched = match_peaks(batch.peak_indices_corrected, stream.peak_indices_corrected, TOLERANCE)
+    assert matched['sensitivity'] >= LIMITS[outliers][0]
+    assert matched['ppv'] >= LIMITS[outliers][1]
@@ -1,12 +1,20 @@
 import pandas as pd
 import numpy as np
 import os
+import re
+import json
 import shutil
 import tarfile
+import queue
 import logging
+import threading
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 from itertools import cycle
+from typing import List, Dict, Iterator, Iterable, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+
+from src.fiducials import Fiducial_Markers
 
 def start_logger(logger_name: str = 'logger'):
     logger = logging.getLogger(logger_name)
@@ -29,6 +37,37 @@ def read_from_tar(tar_path: str, logger: logging.Logger,  extraction_path: str,
     tar.close()
     logger.info(f'Extracted {tar_path} to {extraction_path}')
 
+def list_tar_subjects(tar_path: str) -> List[str]:
+    with tarfile.open(tar_path, 'r') as tar:
+        return sorted(os.path.splitext(os.path.basename(member.name))[0] for member in tar.getmembers() if member.isreg() and member.name.endswith('.csv'))
+
+def _read_tar_member(tar_path: str, subject: str, delimiter: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    with tarfile.open(tar_path, 'r') as tar:
+        member = next((member for member in tar.getmembers() if member.isreg() and os.path.basename(member.name) == f'{subject}.csv'), None)
+        assert member is not None, f'{subject}.csv not found in {tar_path}'
+        with tar.extractfile(member) as f:
+            if chunksize:
+                yield from pd.read_csv(f, delimiter=delimiter, chunksize=chunksize)
+            else:
+                yield pd.read_csv(f, delimiter=delimiter)
+
+def load_df_from_tar(tar_path: str, subject: str, delimiter: str = ',', chunksize: int = None) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    '''
+    Read the csv of a subject (e.g. 'gt03') straight from the tar file, without extracting it to disk
+    With chunksize, an iterator over DataFrames of chunksize rows is returned instead (the tar stays open while iterating).
+    '''
+    chunks = _read_tar_member(tar_path, subject, delimiter, chunksize)
+    return chunks if chunksize else next(chunks)
+
+def load_dfs_from_tar(tar_path: str, subjects: List[str] = None, delimiter: str = ',', max_workers: int = None) -> Dict[str, pd.DataFrame]:
+    '''
+    Read the csv of several subjects from the tar file in parallel (every thread opens its own handle on the tar)
+    '''
+    subjects = subjects or list_tar_subjects(tar_path)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dfs = executor.map(lambda subject: load_df_from_tar(tar_path, subject, delimiter), subjects)
+        return dict(zip(subjects, dfs))
+
 def read_from_file(parent_dir: str, logger: logging.Logger):
     pass
 
@@ -36,47 +75,222 @@ def load_df_from_csv(file_path: str, delimiter: str = ',') -> pd.DataFrame:
     assert file_path.endswith('.csv'), 'File must be a csv file'
     return pd.read_csv(file_path, delimiter=delimiter)
 
-def plot_signal_with_markers(signal: pd.Series, *markers, title: str = None, xlabel: str = 'Time (s)', ylabel: str = 'Amplitude', sampling_rate: int = 2000):
-    color_markers = cycle(["maroon", "navy", "olive", "purple", "red", "silver", "teal", "yellow"])
-    time_index = np.arange(0, len(signal)/sampling_rate, 1/sampling_rate)
-    plt.plot(time_index, signal / signal.max(), label = signal.name, color='black')
-    for marker in markers:
-        plt.scatter(time_index[marker], signal[marker] / signal.max(), label = marker.name, color=next(color_markers))
+def split_sessions(chunks: Iterable[pd.DataFrame], sessions: List[int] = None, dtype: str = None) -> Iterator[Tuple[int, pd.DataFrame]]:
+    '''
+    Group a stream of row chunks by the session column and yield (session, DataFrame) as soon as a session is complete
+    The rows of a session must be contiguous (as recorded): a session ends when a chunk ends in a later one, so only the
+    session being read is held in memory. Rows of sessions not in sessions are dropped as they are read.
+    '''
+    current, buffer, done = None, [], set()
+    for chunk in chunks:
+        if dtype:
+            floating = chunk.select_dtypes('floating').columns
+            chunk = chunk.astype({column: dtype for column in floating}, copy=False)
+        for session, rows in chunk.groupby('session', sort=False):
+            if session != current:
+                if buffer:
+                    yield current, pd.concat(buffer, ignore_index=True)
+                done.add(current)
+                if session in done:
+                    raise ValueError(f'Rows of session {session} are not contiguous, use load_session (column cache) instead')
+                current, buffer = session, []
+            if sessions is None or session in sessions:
+                buffer.append(rows)
+    if buffer:
+        yield current, pd.concat(buffer, ignore_index=True)
+
+def prefetch(iterator: Iterator, size: int) -> Iterator:
+    '''
+    Run an iterator in a background thread, keeping up to size items ready while the caller works on the current one
+    '''
+    items, end = queue.Queue(maxsize=size), object()
+    def fill():
+        try:
+            for item in iterator:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        items.put(end)
+    threading.Thread(target=fill, daemon=True).start()
+    while (item := items.get()) is not end:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def iter_sessions(file_path: str, sessions: List[int] = None, columns: List[str] = None, dtype: str = None, chunksize: int = 100000, delimiter: str = ',', prefetch_sessions: int = 0) -> Iterator[Tuple[int, pd.DataFrame]]:
+    '''
+    Stream the csv file in chunks of chunksize rows and yield one (session, DataFrame) at a time
+    Only the columns matching one of the regex patterns in columns are parsed (the session column always is), so the peak
+    memory is bounded by the largest session instead of the whole file. With prefetch_sessions, the next sessions are read
+    and filled in a background thread while the current one is processed.
+    '''
+    assert file_path.endswith('.csv'), 'File must be a csv file'
+    usecols = None if columns is None else (lambda name: name == 'session' or any(re.search(pattern, name) for pattern in columns))
+    chunks = pd.read_csv(file_path, delimiter=delimiter, usecols=usecols, chunksize=chunksize)
+    grouped = split_sessions(chunks, sessions, dtype)
+    return prefetch(grouped, prefetch_sessions) if prefetch_sessions else grouped
+
+def get_cache_dir(file_path: str) -> str:
+    directory, file_name = os.path.split(os.path.abspath(file_path))
+    return os.path.join(directory, '.cache', os.path.splitext(file_name)[0])
+
+def is_cache_valid(file_path: str, cache_dir: str = None) -> bool:
+    index_path = os.path.join(cache_dir or get_cache_dir(file_path), 'index.json')
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path) as f:
+        source = json.load(f)['source']
+    stat = os.stat(file_path)
+    return source['size'] == stat.st_size and source['mtime_ns'] == stat.st_mtime_ns
+
+def build_session_cache(file_path: str, logger: logging.Logger = None, cache_dir: str = None, delimiter: str = ',') -> str:
+    '''
+    Convert the csv file to one .npy file per column, with the rows grouped by session
+    The index (index.json) stores the row range of every session and the size / modification time of the csv,
+    so the cache is rebuilt when the csv changes.
+    '''
+    cache_dir = cache_dir or get_cache_dir(file_path)
+    stat = os.stat(file_path)
+    df = load_df_from_csv(file_path, delimiter=delimiter)
+    order = np.argsort(df['session'].values, kind='stable')
+    sessions, starts, counts = np.unique(df['session'].values[order], return_index=True, return_counts=True)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+    columns = {}
+    for i, column in enumerate(df.columns):
+        values = df[column].values[order]
+        if values.dtype == object:
+            values = values.astype(str)
+        np.save(os.path.join(cache_dir, f'{i}.npy'), values)
+        columns[column] = f'{i}.npy'
+    index = {
+        'source': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns},
+        'columns': columns,
+        'sessions': {str(session): [int(start), int(start + count)] for session, start, count in zip(sessions, starts, counts)}
+    }
+    # The index is written last, an interrupted build is never taken for a valid cache
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    if logger:
+        logger.info(f'Cached {file_path} to {cache_dir}')
+    return cache_dir
+
+def load_session(file_path: str, session: int, columns: List[str] = None, logger: logging.Logger = None, cache_dir: str = None, dtype: str = None) -> pd.DataFrame:
+    '''
+    Load one session of the csv file from its column cache (built on first use or when the csv changed)
+    Only the rows of the session and the columns matching one of the given regex patterns are read (memory-mapped).
+    Floating point columns are converted to dtype if given (e.g. 'float32').
+    '''
+    cache_dir = cache_dir or get_cache_dir(file_path)
+    if not is_cache_valid(file_path, cache_dir):
+        build_session_cache(file_path, logger, cache_dir)
+    with open(os.path.join(cache_dir, 'index.json')) as f:
+        index = json.load(f)
+    assert str(session) in index['sessions'], f'Session {session} not found in {file_path}'
+    start, stop = index['sessions'][str(session)]
+    names = [name for name in index['columns'] if columns is None or any(re.search(pattern, name) for pattern in columns)]
+    df = {}
+    for name in names:
+        values = np.load(os.path.join(cache_dir, index['columns'][name]), mmap_mode='r')[start:stop]
+        df[name] = values.astype(dtype) if dtype and np.issubdtype(values.dtype, np.floating) else values
+    return pd.DataFrame(df)
+
+def marker_positions(marker: Union[Fiducial_Markers, pd.Series, np.ndarray]) -> np.ndarray:
+    # Markers are either a Fiducial_Markers store or a boolean mask of the signal
+    return marker.indices if isinstance(marker, Fiducial_Markers) else np.flatnonzero(np.asarray(marker))
+
+def downsample_minmax(signal: np.ndarray, n_out: int) -> np.ndarray:
+    '''
+    Indices of the first and last samples and of the minimum and maximum of each of n_out // 2 equal buckets, in order
+    Keeps every peak and trough of the envelope, so a line through them looks the same as the full signal at screen resolution.
+    '''
+    n_buckets = max(n_out // 2, 1)
+    width = -(-len(signal) // n_buckets)
+    padded = np.pad(np.asarray(signal, dtype=float), (0, n_buckets * width - len(signal)), mode='edge').reshape(n_buckets, width)
+    starts = np.arange(n_buckets) * width
+    indices = np.concatenate([[0, len(signal) - 1], starts + padded.argmin(axis=1), starts + padded.argmax(axis=1)])
+    return np.unique(np.minimum(indices, len(signal) - 1))
+
+def downsample_lttb(signal: np.ndarray, n_out: int) -> np.ndarray:
+    '''
+    Indices picked by Largest-Triangle-Three-Buckets: the first and last samples plus, per bucket, the sample forming the largest
+    triangle with the previously picked sample and the mean of the next bucket
+    '''
+    y = np.asarray(signal, dtype=float)
+    edges = np.linspace(1, len(y) - 1, max(n_out - 2, 1) + 1).astype(int)
+    picked = np.empty(len(edges) + 1, dtype=int)
+    picked[0], picked[-1] = 0, len(y) - 1
+    for bucket in range(len(edges) - 1):
+        start, stop = edges[bucket], edges[bucket + 1]
+        following = slice(stop, edges[bucket + 2]) if bucket + 2 < len(edges) else slice(len(y) - 1, len(y))
+        x_next, y_next = (following.start + following.stop - 1) / 2, y[following].mean()
+        x_prev, y_prev = picked[bucket], y[picked[bucket]]
+        x = np.arange(start, stop)
+        area = np.abs((x_prev - x_next) * (y[start:stop] - y_prev) - (x_prev - x) * (y_next - y_prev))
+        picked[bucket + 1] = start + area.argmax()
+    return np.unique(picked)
+
+downsamplers = {'minmax': downsample_minmax, 'lttb': downsample_lttb}
+
+def render_indices(signal: np.ndarray, max_points: int = None, method: str = 'minmax') -> np.ndarray:
+    '''
+    Sample indices to draw for a signal: all of them if it is short enough (or max_points is None), otherwise a min / max or LTTB selection
+    '''
+    if max_points is None or len(signal) <= max_points:
+        return np.arange(len(signal))
+    assert method in downsamplers, f'Unknown downsampling method {method}, use one of {list(downsamplers)}'
+    return downsamplers[method](signal, max_points)
+
+def finish_plot(title: str = None, xlabel: str = None, ylabel: str = None, save_path: str = None, legend: bool = True):
     plt.xlabel(xlabel)
     plt.ylabel(ylabel)
     if title:
         plt.title(title)
-    plt.legend(loc="best")
+    if legend:
+        plt.legend(loc="best")
     plt.grid(axis='x',color='r', linestyle='--', linewidth=0.2)
-    plt.show()
+    if save_path:
+        # Headless mode: write the figure instead of opening a window
+        plt.savefig(save_path, dpi=150, bbox_inches='tight')
+        plt.close()
+    else:
+        plt.show()
+
+def plot_signal_with_markers(signal: pd.Series, *markers, title: str = None, xlabel: str = 'Time (s)', ylabel: str = 'Amplitude', sampling_rate: int = 2000, max_points: int = 4000, method: str = 'minmax', save_path: str = None):
+    '''
+    Plot a signal normalised by its maximum with its fiducial markers
+    The line is downsampled to max_points (see render_indices), the markers are always drawn at their exact samples.
+    With save_path the figure is written to that file instead of shown.
+    '''
+    color_markers = cycle(["maroon", "navy", "olive", "purple", "red", "silver", "teal", "yellow"])
+    values = np.asarray(signal)
+    scale = values.max()
+    drawn = render_indices(values, max_points, method)
+    plt.plot(drawn / sampling_rate, values[drawn] / scale, label = signal.name, color='black')
+    for marker in markers:
+        positions = marker_positions(marker)
+        plt.scatter(positions / sampling_rate, values[positions] / scale, label = marker.name, color=next(color_markers))
+    finish_plot(title, xlabel, ylabel, save_path)
 
-def plot_signals_with_marker(*signals, marker: pd.Series, title: str = None, xlabel: str = 'Time (s)', ylabel: str = 'Amplitude', sampling_rate: int = 2000):
+def plot_signals_with_marker(*signals, marker: Union[Fiducial_Markers, pd.Series], title: str = None, xlabel: str = 'Time (s)', ylabel: str = 'Amplitude', sampling_rate: int = 2000, max_points: int = 4000, method: str = 'minmax', save_path: str = None):
     assert len(signals) > 0, 'At least one signal must be provided'
     color_signals = cycle(["black", "blue", "fuchsia", "gray", "green", "lime"])
-    time_index = np.arange(0, len(signals[0])/sampling_rate, 1/sampling_rate)
     for signal in signals:
-        plt.plot(time_index, signal / signal.max(), label = signal.name, color=next(color_signals))
-    plt.scatter(time_index[marker], signals[0][marker] / signals[0].max(), label = marker.name, color='red')
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    if title:
-        plt.title(title)
-    plt.legend(loc="best")
-    plt.grid(axis='x',color='r', linestyle='--', linewidth=0.2)
-    plt.show()
+        values = np.asarray(signal)
+        drawn = render_indices(values, max_points, method)
+        plt.plot(drawn / sampling_rate, values[drawn] / values.max(), label = signal.name, color=next(color_signals))
+    positions = marker_positions(marker)
+    reference = np.asarray(signals[0])
+    plt.scatter(positions / sampling_rate, reference[positions] / reference.max(), label = marker.name, color='red')
+    finish_plot(title, xlabel, ylabel, save_path)
 
 
-def plot_signal(*signals, xlabel: str = 'Time (s)', ylabel: str = 'Amplitude', sampling_rate: int = 2000, by_time: bool = True):
+def plot_signal(*signals, xlabel: str = 'Time (s)', ylabel: str = 'Amplitude', sampling_rate: int = 2000, by_time: bool = True, max_points: int = 4000, method: str = 'minmax', save_path: str = None):
     colors = cycle(["aqua", "black", "blue", "fuchsia", "gray", "green", "lime", "maroon", "navy", "olive", "purple", "red", "silver", "teal", "yellow"])
     for signal in signals:
         label = signal.name if isinstance(signal, pd.Series) else 'Signal'
-        if by_time:
-            time_index = np.arange(0, len(signal)/sampling_rate, 1/sampling_rate)
-            plt.plot(time_index, signal, label = label, color=next(colors))
-        else:
-            plt.plot(signal, label = label, color=next(colors))
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    plt.legend(loc="best")
-    plt.grid(axis='x',color='r', linestyle='--', linewidth=0.2)
-    plt.show()
+        values = np.asarray(signal)
+        drawn = render_indices(values, max_points, method)
+        x = drawn / sampling_rate if by_time else (signal.index[drawn] if isinstance(signal, pd.Series) else drawn)
+        plt.plot(x, values[drawn], label = label, color=next(colors))
+    finish_plot(None, xlabel, ylabel, save_path)